@@ -5,7 +5,7 @@ data "aws_iam_policy_document" "lambda" {
   count = var.create ? 1 : 0
 
   dynamic "statement" {
-    for_each = concat([local.lambda_policy_document], var.kms_key_arn != "" ? [local.lambda_policy_document_kms] : [])
+    for_each = concat([local.lambda_policy_document], var.kms_key_arn != "" ? [local.lambda_policy_document_kms] : [], var.store_table_name != "" ? [local.lambda_policy_document_dynamodb] : [], length(var.webhook_secret_arns) > 0 ? [local.lambda_policy_document_secrets] : [], var.outbox_store == "sqs" ? [local.lambda_policy_document_outbox] : [], var.create_sqs_queue ? [local.lambda_policy_document_events_queue] : [], var.alarm_metadata ? [local.lambda_policy_document_alarm_metadata] : [], substr(var.routes_uri, 0, 5) == "s3://" ? [local.lambda_policy_document_routes] : [])
     content {
       sid       = statement.value.sid
       effect    = statement.value.effect
@@ -116,5 +116,103 @@ data "aws_iam_policy_document" "sns_topic_policy" {
     sid = "AWSCloudWatchNotifications"
   }
 
+  dynamic "statement" {
+    for_each = length(var.aggregation_account_ids) > 0 ? [var.aggregation_account_ids] : []
+    content {
+      actions = [
+        "SNS:Publish"
+      ]
+
+      condition {
+        test     = "StringEquals"
+        variable = "AWS:SourceAccount"
+
+        values = statement.value
+      }
+
+      effect = "Allow"
 
+      principals {
+        type        = "Service"
+        identifiers = ["cloudwatch.amazonaws.com", "codestar-notifications.amazonaws.com", "events.amazonaws.com"]
+      }
+
+      resources = var.create_sns_topic ? [
+        aws_sns_topic.this[0].arn,
+        ] : [
+        local.sns_topic_arn
+      ]
+
+      sid = "AggregatedAccountsNotifications"
+    }
+  }
+
+  dynamic "statement" {
+    for_each = length(var.aggregation_account_ids) > 0 ? [var.aggregation_account_ids] : []
+    content {
+      actions = [
+        "SNS:Publish"
+      ]
+
+      effect = "Allow"
+
+      principals {
+        type        = "AWS"
+        identifiers = [for account_id in statement.value : "arn:${data.aws_partition.current.id}:iam::${account_id}:root"]
+      }
+
+      resources = var.create_sns_topic ? [
+        aws_sns_topic.this[0].arn,
+        ] : [
+        local.sns_topic_arn
+      ]
+
+      sid = "AggregatedAccountsPublish"
+    }
+  }
+
+
+}
+
+data "aws_iam_policy_document" "events_queue" {
+  count = var.create_sqs_queue && var.create ? 1 : 0
+
+  statement {
+    sid       = "AllowSNSTopic"
+    effect    = "Allow"
+    actions   = ["sqs:SendMessage"]
+    resources = [aws_sqs_queue.events[0].arn]
+
+    principals {
+      type        = "Service"
+      identifiers = ["sns.amazonaws.com"]
+    }
+
+    condition {
+      test     = "ArnEquals"
+      variable = "aws:SourceArn"
+      values   = [local.sns_topic_arn]
+    }
+  }
+
+  dynamic "statement" {
+    for_each = length(aws_cloudwatch_event_rule.events) > 0 ? [[for rule in aws_cloudwatch_event_rule.events : rule.arn]] : []
+    content {
+      sid       = "AllowEventBridgeRules"
+      effect    = "Allow"
+      actions   = ["sqs:SendMessage"]
+      resources = [aws_sqs_queue.events[0].arn]
+
+      principals {
+        type        = "Service"
+        identifiers = ["events.amazonaws.com"]
+      }
+
+      condition {
+        test     = "ArnEquals"
+        variable = "aws:SourceArn"
+        values   = statement.value
+      }
+    }
+  }
 }
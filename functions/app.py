@@ -1,9 +1,25 @@
+import time
+# Start of the module import, reported by the first invocation of a cold container
+IMPORT_STARTED = time.perf_counter()
+
 import os
 import json
 import logging
-#import requests
-import urllib
-from botocore.vendored import requests
+import random
+import re
+import threading
+import socket
+import http.client
+import urllib.parse
+import uuid
+from collections import namedtuple
+from functools import lru_cache
+import stores
+import metrics
+import outbox
+import lifecycle
+import routing
+import webhook_secrets
 
 # ---------------------------------------------------------------------------------------------------------------------
 # ENVIRONMENT VARIABLES
@@ -11,14 +27,52 @@ from botocore.vendored import requests
 
 LOG_LEVEL=(os.environ.get("LOG_LEVEL", "INFO").upper())
 LOG_EVENTS = os.getenv('LOG_EVENTS', 'False').lower() in ('true', '1', 't', 'yes', 'y')
-WEBHOOK_URL = os.environ['WEBHOOK_URL']
-MESSENGER = os.environ['MESSENGER']
+LOG_EVENTS_SAMPLE_RATE = float(os.getenv('LOG_EVENTS_SAMPLE_RATE', '1'))
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()
+LOG_MAX_EVENT_SIZE = int(os.getenv('LOG_MAX_EVENT_SIZE', '2048'))
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+MESSENGER = os.getenv('MESSENGER', '')
+DESTINATIONS = json.loads(os.getenv('DESTINATIONS') or '[]')
+DELIVERY_MAX_WORKERS = int(os.getenv('DELIVERY_MAX_WORKERS', '8'))
+DELIVERY_MODE = os.getenv('DELIVERY_MODE', 'threads').lower()
+COALESCE_WINDOW = int(os.getenv('COALESCE_WINDOW', '0'))
+COALESCE_MAX_COUNT = int(os.getenv('COALESCE_MAX_COUNT', '20'))
+COALESCE_SOURCES = [source for source in os.getenv('COALESCE_SOURCES', 'aws.ecs').split(',') if source]
+COALESCE_STORE = os.getenv('COALESCE_STORE', 'memory')
+DEDUP_WINDOW = int(os.getenv('DEDUP_WINDOW', '0'))
+DEDUP_CACHE_SIZE = int(os.getenv('DEDUP_CACHE_SIZE', '1024'))
+DEDUP_STORE = os.getenv('DEDUP_STORE', '')
+RATE_LIMITS = json.loads(os.getenv('RATE_LIMITS') or '{}')
+RATE_LIMIT_MAX_WAIT = float(os.getenv('RATE_LIMIT_MAX_WAIT', '10'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '3'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '10'))
+HTTP_TOTAL_TIMEOUT = float(os.getenv('HTTP_TOTAL_TIMEOUT', '20'))
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', '3'))
+HTTP_BACKOFF_BASE = float(os.getenv('HTTP_BACKOFF_BASE', '0.5'))
+HTTP_BACKOFF_MAX = float(os.getenv('HTTP_BACKOFF_MAX', '8'))
+RULES = json.loads(os.getenv('RULES') or '[]')
+OUTBOX_STORE = os.getenv('OUTBOX_STORE', '')
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '5'))
+OUTBOX_BACKOFF_BASE = float(os.getenv('OUTBOX_BACKOFF_BASE', '60'))
+OUTBOX_BACKOFF_MAX = float(os.getenv('OUTBOX_BACKOFF_MAX', '3600'))
+STYLES_OVERRIDES = json.loads(os.getenv('STYLES') or '{}')
+MEMO_CACHE_SIZE = int(os.getenv('MEMO_CACHE_SIZE', '1024'))
+ALARM_METADATA = os.getenv('ALARM_METADATA', 'False').lower() in ('true', '1', 't', 'yes', 'y')
+ALARM_METADATA_TTL = float(os.getenv('ALARM_METADATA_TTL', '300'))
+AWS_REGION = os.getenv('AWS_REGION', '')
+LIFECYCLE_STORE = os.getenv('LIFECYCLE_STORE', '')
+SLACK_API_URL = os.getenv('SLACK_API_URL', 'https://slack.com/api')
+
+# In aggregation mode WEBHOOK_URL and MESSENGER are the destination of the events without route, optional when the
+# routing table has a catch-all route
+if not DESTINATIONS and (WEBHOOK_URL or not routing.enabled()):
+    if WEBHOOK_URL == '':
+        raise RuntimeError('The required env variable WEBHOOK_URL is not set or empty!')
 
-if WEBHOOK_URL == '':
-    raise RuntimeError('The required env variable WEBHOOK_URL is not set or empty!')
+    if MESSENGER == '':
+        raise RuntimeError('The required env variable MESSENGER is not set or empty!')
 
-if MESSENGER == '':
-    raise RuntimeError('The required env variable MESSENGER is not set or empty!')
+    DESTINATIONS = [{'messenger': MESSENGER, 'webhook_url': WEBHOOK_URL}]
 
 # ---------------------------------------------------------------------------------------------------------------------
 # HELPER FUNCTIONS
@@ -26,641 +80,2002 @@ if MESSENGER == '':
 log = logging.getLogger()
 log.setLevel(LOG_LEVEL)
 
-# Handler event
+# Invocation fields added to every structured log line
+log_context = {'request_id': None}
+
+# JSON lines formatter, used when LOG_FORMAT is json
+class JSONFormatter(logging.Formatter):
+    FIELDS = ('record_id', 'source', 'messenger', 'status', 'render_ms', 'http_ms', 'import_ms')
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'request_id': log_context['request_id'],
+            'message': record.getMessage(),
+        }
+        for field in self.FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+if LOG_FORMAT == 'json':
+    if not log.handlers:
+        log.addHandler(logging.StreamHandler())
+    for handler in log.handlers:
+        handler.setFormatter(JSONFormatter())
+
+# Per delivery timings are part of the structured logs, and only debugging information otherwise
+DELIVERY_LOG_LEVEL = logging.INFO if LOG_FORMAT == 'json' else logging.DEBUG
+
+# Defer building a log argument until the record is emitted
+class Lazy:
+    __slots__ = ('func',)
+
+    def __init__(self, func):
+        self.func = func
+
+    def __str__(self):
+        return str(self.func())
+
+# Compact JSON of an event, truncated to LOG_MAX_EVENT_SIZE characters
+def truncated_json(value):
+    text = json.dumps(value, default=str)
+    if LOG_MAX_EVENT_SIZE and len(text) > LOG_MAX_EVENT_SIZE:
+        return f'{text[:LOG_MAX_EVENT_SIZE]}... ({len(text)} characters)'
+    return text
+
+# Event parsers building the Notification of a message, keyed by EventBridge `source`, (`source`, `detail-type`) or
+# CLOUDWATCH_ALARM
+EVENT_HANDLERS = {}
+CLOUDWATCH_ALARM = 'AlarmName'
+
+# Records delivered by services that do not go through SNS
+RECORD_SOURCES = {
+    'aws:s3': 's3',
+    'aws:codecommit': 'codecommit',
+    'aws:ses': 'ses',
+}
+
+# Register parser for one or more event keys
+def event_handler(*keys):
+    def register(func):
+        for key in keys:
+            EVENT_HANDLERS[key] = func
+        return func
+    return register
+
+# Classify parsed message
+def classify(message):
+    if not isinstance(message, dict):
+        return None
+    if CLOUDWATCH_ALARM in message:
+        return EVENT_HANDLERS.get(CLOUDWATCH_ALARM)
+    source = message.get('source')
+    return EVENT_HANDLERS.get((source, message.get('detail-type'))) or EVENT_HANDLERS.get(source)
+
+# Read the event message carried by a SNS or SQS record
+def record_message(record: dict):
+    if 'Sns' in record:
+        return json.loads(record['Sns']['Message'])
+    if record.get('eventSource') == 'aws:sqs':
+        message = json.loads(record['body'])
+        # SNS to SQS subscriptions without raw message delivery keep the SNS envelope
+        if isinstance(message, dict) and message.get('Type') == 'Notification' and 'Message' in message:
+            message = json.loads(message['Message'])
+        return message
+    return None
+
+# Parse record, returns the event message or the RECORD_SOURCES name
+def parse_record(record: dict):
+    if record.get('eventSource') in RECORD_SOURCES:
+        return RECORD_SOURCES[record['eventSource']]
+    try:
+        return eventbridge_message(record_message(record))
+    except ValueError:
+        log.error('Error parsing record message: `{}`'.format(record.get('messageId', record.get('Sns', {}).get('MessageId'))))
+        return None
+
+def is_eventbridge_event(event):
+    return isinstance(event, dict) and 'detail-type' in event and 'source' in event
+
+# CloudWatch alarm state change sent by EventBridge, converted to the SNS alarm notification
+def alarm_notification(event: dict):
+    detail = event.get('detail', {})
+    return {
+        'AlarmName': detail.get('alarmName'),
+        'AlarmDescription': detail.get('configuration', {}).get('description'),
+        'AlarmArn': (event.get('resources') or [None])[0],
+        'AWSAccountId': event.get('account'),
+        'NewStateValue': detail.get('state', {}).get('value'),
+        'NewStateReason': detail.get('state', {}).get('reason'),
+        'StateChangeTime': detail.get('state', {}).get('timestamp'),
+        'Region': event.get('region'),
+        'OldStateValue': detail.get('previousState', {}).get('value'),
+    }
+
+# EventBridge events whose SNS notification format is rendered instead, keyed by (`source`, `detail-type`)
+EVENTBRIDGE_ADAPTERS = {
+    ('aws.cloudwatch', 'CloudWatch Alarm State Change'): alarm_notification,
+}
+
+def eventbridge_message(message):
+    if is_eventbridge_event(message):
+        adapter = EVENTBRIDGE_ADAPTERS.get((message['source'], message['detail-type']))
+        if adapter is not None:
+            return adapter(message)
+    return message
+
+# Events of the EventBridge schedule, they only flush the coalesced notifications and the outbox
+SCHEDULED_EVENT = 'Scheduled Event'
+
+# Event received by the function, from a SNS, SQS or other service record, or from an EventBridge rule invoking the
+# function directly. `origin` is `eventbridge` or the record event source without its `aws:` prefix, and `message`
+# the parsed event message once parse_input ran
+class InputEvent:
+    __slots__ = ('id', 'origin', 'record', 'message')
+
+    def __init__(self, id, origin, record):
+        self.id = id
+        self.origin = origin
+        self.record = record
+        self.message = None
+
+# Items of an invocation, the records of the event or the EventBridge event itself
+def input_items(event: dict):
+    if is_eventbridge_event(event):
+        return [] if event['detail-type'] == SCHEDULED_EVENT else [event]
+    return event.get('Records', [])
+
+def input_event(item: dict):
+    if is_eventbridge_event(item):
+        return InputEvent(item.get('id'), 'eventbridge', item)
+    return InputEvent(record_id(item), 'sns' if 'Sns' in item else item.get('eventSource', '').replace('aws:', ''), item)
+
+# Parse the message of an input, EventBridge events are dicts already and skip the JSON decoding of records
+def parse_input(received: InputEvent):
+    if received.origin == 'eventbridge':
+        received.message = eventbridge_message(received.record)
+    else:
+        received.message = parse_record(received.record)
+    return received.message
+
+# Render parsed message for messenger
+def render(messenger, message):
+    return render_notification(messenger, notify(message))
+
+# Handler event, renders the first record or the EventBridge event
 def handle_event(messenger, event: dict):
-    # S3
-    if 'Records' in event and len(event['Records']) > 0 and 'eventSource' in event['Records'][0] and event['Records'][0]['eventSource'] == 'aws:s3':
-        return 's3'
-
-    # SNS
-    #elif 'Records' in event and len(event['Records']) > 0 and 'EventSource' in event['Records'][0] and event['Records'][0]['EventSource'] == 'aws:sns' and 'aws.codepipeline' not in event['Records'][0]['Sns']['Message'] and 'AlarmName' not in event['Records'][0]['Sns']['Message']:
-    #    return 'sns'
-
-    # Codepipeline
-    elif 'Records' in event and len(event['Records']) > 0 and 'EventSource' in event['Records'][0] and 'aws.codepipeline' in event['Records'][0]['Sns']['Message']:
-        message = json.loads(event['Records'][0]['Sns']['Message'])
-        aws_account_id = message.get('account', None)
-        aws_region = message.get('region', None)
-        event_time = message.get('time', None)
-        pipeline = message.get('detail', {}).get('pipeline', None)
-        state = message.get('detail', {}).get('state', None)
-        pipeline_url = f'''https://{aws_region}.console.aws.amazon.com/codesuite/codepipeline/pipelines/{pipeline}/view?region={aws_region}'''
-        color = '808080'
-        blocks = list()
-        footer = list()
-        if state == 'SUCCEEDED':
-            color = '00ff00'
-            status = 'succeeded'
-            squadcast_status = "resolve"
-            msteams_color = "good"
-        elif state == 'STARTED':
-            color = '00bbff'
-            status = 'started'
-            squadcast_status = "trigger"
-            msteams_color = "default"
-        elif state == 'FAILED':
-            color = 'ff0000'
-            status = 'failed'
-            squadcast_status = "trigger"
-            msteams_color = "attention"
-        elif state == 'SUPERSEDED':
-            color = '808080'
-            status = 'superseded'
-            squadcast_status = "resolve"
-            msteams_color = "light"
-        else:
-            color = '000000'
+    items = input_items(event)
+    if items:
+        return render(messenger, parse_input(input_event(items[0])))
 
-        # Slack
-        if messenger == 'slack':
-            message = {
-                'attachments': [
-                    {
-                        "mrkdwn_in": ["text"],
-                        'fallback': 'Pipeline Status',
-                        'color': f"#{color}",
-                        'author_icon': 'https://www.awsgeek.com/AWS-History/icons/AWS-CodePipeline.svg',
-                        "text": f"CodePipeline {pipeline} {status} (<{pipeline_url}|Open>)"
-                    }
-                ]
-            }
-            return message
-
-        # Squadcast
-        elif messenger == 'squadcast':
-            message = {
-                "message": f"CodePipeline {pipeline} {status}",
-                "description": f"**AWS Account:** {aws_account_id} \n**AWS Region:** {aws_region} \n**Pipeline:** {pipeline} \n**Status:** {status} \n**URL:** {pipeline_url} \n**Priority:** P5",
-                "status": f"{squadcast_status}",
-                "event_id": f"CodePipeline {pipeline} {status}"
-            }
-            return message
-
-        # Discord
-        elif messenger == 'discord':
-            color = int(color, base=16)
-            message = {
-                'embeds': [
-                    {
-                        "title": f"CodePipeline {pipeline} {status}",
-                        "description": f"[Open]({pipeline_url})",
-                        "color": color
-                    }
-                ]
-            }
-            return message
-
-        # Microsoft Teams
-        elif messenger == 'msteams':
-            message = {
-                "type": "message",
-                "attachments": [
-                    {
-                        "contentType": "application/vnd.microsoft.card.adaptive",
-                        "content": {
-                            "type": "AdaptiveCard",
-                            "$schema":"http://adaptivecards.io/schemas/adaptive-card.json",
-                            "version": "1.4",
-                            "msteams": {  
-                                "width": "Full"  
-                            },  
-                            "body": [
-                                {
-                                    "type": "Container",
-                                    "style": msteams_color,
-                                    "items": [
-                                        {
-                                            "type": "TextBlock",
-                                            "size": "Large",
-                                            "weight": "Bolder",
-                                            "text": f"CodePipeline {pipeline} {status}",
-                                        },
-                                        {
-                                            "type": "TextBlock",
-                                            "text": f"AWS Account: {aws_account_id}\n\nAWS Region: {aws_region}\n\nPipeline: {pipeline}",
-                                            "wrap": True,
-                                        },
-                                        {
-                                            "type": "ActionSet",
-                                            "actions": [
-                                                {
-                                                    "type": "Action.OpenUrl",
-                                                    "title": "More Info",
-                                                    "url": pipeline_url
-                                                }
-                                            ]
-                                        }
-                                    ]
-                                }
-                            ],
-                        }
-                    }
-                ]
-            }
-            return message
-        
-    # CodeBuild
-    elif 'Records' in event and len(event['Records']) > 0 and 'EventSource' in event['Records'][0] and 'aws.codebuild' in event['Records'][0]['Sns']['Message']:
-        message = json.loads(event['Records'][0]['Sns']['Message'])
-        aws_account_id = message.get('account', None)
-        aws_region = message.get('region', None)
-        event_time = message.get('time', None)
-        project_name = message.get('detail', {}).get('project-name', None)
-        status = message.get('detail', {}).get('build-status', None)
-        codebuild_url = f'''https://{aws_region}.console.aws.amazon.com/codesuite/codebuild/pipelines/{project_name}/view?region={aws_region}'''
-        color = '808080'
-        blocks = list()
-        footer = list()
-        if status == 'SUCCEEDED':
-            color = '00ff00'
-            status = 'succeeded'
-            squadcast_status = "resolve"
-            msteams_color = "good"
-        elif status == 'FAILED':
-            color = 'ff0000'
-            status = 'failed'
-            squadcast_status = "trigger"
-            msteams_color = "attention"
-        elif status == 'IN_PROGRESS':
-            color = '808080'
-            status = 'in-progress'
-            squadcast_status = "resolve"
-            msteams_color = "default"
-        elif status == 'STOPPED':
-            color = 'ff0000'
-            status = 'failed'
-            squadcast_status = "trigger"
-            msteams_color = "default"
-        else:
-            color = '000000'
-            status = 'unknow'
-            squadcast_status = "trigger"
-            msteams_color = "default"
+# ---------------------------------------------------------------------------------------------------------------------
+# MEMOIZATION
+# ---------------------------------------------------------------------------------------------------------------------
+# Values derived from a resource are memoized by the warm container, the same alarms and pipelines notify over and
+# over. Parsed ARNs and alarm console URLs never change and use lru_cache, alarm metadata fetched from the CloudWatch
+# API is kept in a bounded TTL cache so that changes show up. Hits and misses are logged at debug level.
 
-        # Slack
-        if messenger == 'slack':
-            message = {
-                'attachments': [
-                    {
-                        "mrkdwn_in": ["text"],
-                        'fallback': 'Pipeline Status',
-                        'color': f"#{color}",
-                        'author_icon': 'https://www.awsgeek.com/AWS-History/icons/AWS-CodeBuild.svg',
-                        "text": f"Codebuild {project_name} {status} (<{codebuild_url}|Open>)"
-                    }
-                ]
-            }
-            return message
-
-        # Squadcast
-        elif messenger == 'squadcast':
-            message = {
-                "message": f"CodeBuild {project_name} {status}",
-                "description": f"**AWS Account:** {aws_account_id} \n**AWS Region:** {aws_region} \n**Project:** {project_name} \n**Status:** {status} \n**URL:** {codebuild_url} \n**Priority:** P5",
-                "status": f"{squadcast_status}",
-                "event_id": f"CodeBuild {project_name} {status}"
-            }
-            return message
-
-        # Discord
-        elif messenger == 'discord':
-            color = int(color, base=16)
-            message = {
-                'embeds': [
-                    {
-                        "title": f"CodeBuild {pipeline} {status}",
-                        "description": f"[Open]({pipeline_url})",
-                        "color": color
-                    }
-                ]
-            }
-            return message
-
-        # Microsoft Teams
-        elif messenger == 'msteams':
-            message = {
-                "type": "message",
-                "attachments": [
-                    {
-                        "contentType": "application/vnd.microsoft.card.adaptive",
-                        "content": {
-                            "type": "AdaptiveCard",
-                            "$schema":"http://adaptivecards.io/schemas/adaptive-card.json",
-                            "version": "1.4",
-                            "msteams": {  
-                                "width": "Full"  
-                            },  
-                            "body": [
-                                {
-                                    "type": "Container",
-                                    "style": msteams_color,
-                                    "items": [
-                                        {
-                                            "type": "TextBlock",
-                                            "size": "Large",
-                                            "weight": "Bolder",
-                                            "text": f"CodeBuild Summary {pipeline} {status}"
-                                        },
-                                        {
-                                            "type": "TextBlock",
-                                            "text": f"**AWS Account:** {aws_account_id} \n\n**AWS Region:** {aws_region} \n\n**Project:** {project_name} \n\n**Status:** {status} \n\n**Priority:** P5",
-                                            "wrap": True,
-                                        },
-                                        {
-                                            "type": "ActionSet",
-                                            "actions": [
-                                                {
-                                                    "type": "Action.OpenUrl",
-                                                    "title": "More Info",
-                                                    "url": codebuild_url
-                                                }
-                                            ]
-                                        }
-                                    ]
-                                }
-                            ],
-                        }
-                    }
-                ]
-            }
-            return message
-        
-    # ECS
-    if 'Records' in event and len(event['Records']) > 0 and 'EventSource' in event['Records'][0] and 'aws.ecs' in event['Records'][0]['Sns']['Message']:
-        def ecs_events_parser(detail_type, detail):
-            if detail_type == 'ECS Container Instance State Change':
-                result = f'*Instance ID:* ' + detail['ec2InstanceId'] + '\n' + \
-                         '• Status: ' + detail['status']
-                if 'statusReason' in detail:
-                    result = result + '\n' + '• Reason: ' + detail['statusReason']
-                return result
-
-            if detail_type == 'ECS Deployment State Change':
-                result = f'*Event Detail:*' + '\n' + \
-                         '• ' + detail['eventType'] + ' - ' + detail['eventName'] + '\n' + \
-                         '• Deployment: ' + detail['deploymentId'] + '\n' + \
-                         '• Reason: ' + detail['reason']
-                return result
-
-            elif detail_type == 'ECS Service Action':
-                result = f'*Event Detail:*' + '\n' + \
-                         '• ' + detail['eventType'] + ' - ' + detail['eventName']
-                if 'capacityProviderArns' in detail:
-                    capacity_providers = ""
-                    for capacity_provider in detail['capacityProviderArns']:
-                        try:
-                            capacity_providers = capacity_providers + capacity_provider.split(':')[5].split('/')[1] + ", "
-                        except Exception:
-                            log.error('Error parsing clusterArn: `{}`'.format(capacity_provider))
-                            capacity_providers = capacity_providers + capacity_provider + ", "
-                    if capacity_providers != "":
-                        result = result + '\n' + '• Capacity Providers: ' + capacity_providers
-                return result
-
-            elif detail_type == 'ECS Task State Change':
-                container_instance_id = "UNKNOWN"
-                if 'containerInstanceArn' in detail:
-                    try:
-                        container_instance_id = detail['containerInstanceArn'].split(':')[5].split('/')[2]
-                    except Exception:
-                        log.error('Error parsing containerInstanceArn: `{}`'.format(detail['containerInstanceArn']))
-                        container_instance_id = detail['containerInstanceArn']
-                try:
-                    task_definition = detail['taskDefinitionArn'].split(':')[5].split(
-                        '/')[1] + ":" + detail['taskDefinitionArn'].split(':')[6]
-                except Exception:
-                    log.error('Error parsing taskDefinitionArn: `{}`'.format(detail['taskDefinitionArn']))
-                    task_definition = detail['taskDefinitionArn']
-                try:
-                    task = detail['taskArn'].split(':')[5].split('/')[2]
-                except Exception:
-                    log.error('Error parsing taskArn: `{}`'.format(detail['taskArn']))
-                    task = detail['taskArn']
-                result = f'*Event Detail:* ' + '\n' + \
-                         '• Region: ' + region + '\n' + \
-                         '• Cluster: ' + detail['clusterArn'] + '\n' + \
-                         '• Task Definition: ' + task_definition + '\n' + \
-                         '• Last: ' + detail['lastStatus'] + ' ' + '\n' + \
-                         '• Desired: ' + detail['desiredStatus'] + ' ' + '\n' + \
-                         '• Priority: (P3)' + ' '
-                if container_instance_id != "UNKNOWN":
-                    result = result + '\n' + '• Instance ID: ' + container_instance_id
-                if detail['lastStatus'] == 'RUNNING':
-                    if 'healthStatus' in detail:
-                        result = result + '\n' + '• HealthStatus: ' + detail['healthStatus']
-                if detail['lastStatus'] == 'STOPPED':
-                    if 'stopCode' in detail:
-                        result = result + '\n' + '• Stop Code: ' + detail['stopCode']
-                    if 'stoppedReason' in detail:
-                        result = result + '\n' + '• Stop Reason: ' + detail['stoppedReason']
-                return result
+MISSING = object()
 
-            else:
-                result = f'Detail type "{detail_type}" unknown, see the original event on ECS to more informations.'
-                return result
+alarm_metadata_cache = stores.TTLCache(MEMO_CACHE_SIZE, ALARM_METADATA_TTL)
 
-        def ecs_events_parser_title(detail_type, detail):
-            if detail_type == 'ECS Container Instance State Change':
-                result = "ECS Container Instance State Change"
-                return result
+# Memoize a function of hashable arguments, exceptions are not cached
+def memoized(cache):
+    def decorate(func):
+        def wrapper(*args):
+            value = cache.get(args, MISSING)
+            if value is MISSING:
+                value = func(*args)
+                cache.put(args, value)
+            return value
+        wrapper.cache = cache
+        return wrapper
+    return decorate
 
-            elif detail_type == 'ECS Deployment State Change':
-                result = "ECS Deployment State Change"
-                return result
+def memo_stats():
+    stats = {'alarm_metadata': {'hits': alarm_metadata_cache.hits, 'misses': alarm_metadata_cache.misses, 'size': len(alarm_metadata_cache)}}
+    for func in (parse_arn, alarm_url):
+        info = func.cache_info()
+        stats[func.__name__] = {'hits': info.hits, 'misses': info.misses, 'size': info.currsize}
+    return stats
 
-            elif detail_type == 'ECS Service Action':
-                result = "ECS Service Action"
-                return result
+# ---------------------------------------------------------------------------------------------------------------------
+# NOTIFICATIONS
+# ---------------------------------------------------------------------------------------------------------------------
+# Event parsers build one Notification per event, rendered for every messenger by the templates of its `kind`, or by
+# the generic templates of the messenger for kinds without templates: a new source only needs a parser.
 
-            elif detail_type == 'ECS Task State Change':
-                try:
-                    reason = detail['stoppedReason']
-                except Exception:
-                    reason = "UNKNOWN"
-                try:
-                    group = detail['group']
-                except Exception:
-                    group = "UNKNOWN"
-                result =  f"{reason} on {group}"
-                return result
+# Display status, colors and severity of an event state. A None status displays the state itself
+Style = namedtuple('Style', ('status', 'color', 'msteams_color', 'squadcast_status', 'severity'), defaults=('P5',))
+
+# Styles by event source and state. The `default` state styles the states missing from the table of their source, and
+# the `default` source the sources without a table. STYLES overrides them by source and state, e.g.
+# {"aws.cloudwatch": {"INSUFFICIENT_DATA": {"color": "ffa500", "severity": "P3"}}}
+BUILTIN_STYLES = {
+    'aws.codepipeline': {
+        'SUCCEEDED': Style('succeeded', '00ff00', 'good', 'resolve'),
+        'STARTED': Style('started', '00bbff', 'default', 'trigger'),
+        'FAILED': Style('failed', 'ff0000', 'attention', 'trigger'),
+        'SUPERSEDED': Style('superseded', '808080', 'light', 'resolve'),
+        'default': Style(None, '000000', 'default', 'trigger'),
+    },
+    'aws.codebuild': {
+        'SUCCEEDED': Style('succeeded', '00ff00', 'good', 'resolve'),
+        'FAILED': Style('failed', 'ff0000', 'attention', 'trigger'),
+        'IN_PROGRESS': Style('in-progress', '808080', 'default', 'resolve'),
+        'STOPPED': Style('failed', 'ff0000', 'default', 'trigger'),
+        'default': Style(None, '000000', 'default', 'trigger'),
+    },
+    'aws.cloudwatch': {
+        'ALARM': Style('ALARM', '892621', 'attention', 'trigger'),
+        'OK': Style('OK', '00c575', 'good', 'resolve'),
+        'INSUFFICIENT_DATA': Style('INSUFFICIENT_DATA', '808080', 'warning', 'trigger'),
+        'default': Style(None, '808080', 'default', 'trigger'),
+    },
+    'default': {
+        'default': Style(None, '808080', 'default', 'trigger'),
+    },
+}
+
+# Built-in styles with the STYLES overrides applied, an override state inherits the missing keys from the style it
+# replaces or from the default style of its source
+def load_styles(overrides):
+    styles = {source: dict(states) for source, states in BUILTIN_STYLES.items()}
+    for source, states in overrides.items():
+        table = styles.setdefault(source, {})
+        for state, values in states.items():
+            unknown = set(values) - set(Style._fields)
+            if unknown:
+                raise ValueError(f'Not support style keys {sorted(unknown)} of {source} {state}')
+            base = table.get(state) or table.get('default') or styles['default']['default']
+            table[state] = base._replace(**values)
+    return styles
+
+STYLES = load_styles(STYLES_OVERRIDES)
+
+def state_style(source, state):
+    states = STYLES.get(source) or STYLES['default']
+    style = states.get(state) or states.get('default') or STYLES['default']['default']
+    if style.status is None:
+        return style._replace(status=state or 'unknown')
+    return style
+
+DEFAULT_STYLE = STYLES['default']['default']._replace(status='unknown')
+
+# Normalized event, `fields` are (label: value) pairs shown by the templates, `message` the parsed event message.
+# Rules, deduplication, coalescing, lifecycles and routing only read its identity: `source`, `detail_type`, `state`
+# (the raw event state), `account`, `region`, `resource` (what the state is about), `incident` (the alarm, pipeline
+# execution or build whose notifications update one message), `resolved` (whether it ends the incident, the next
+# notification of a recurring incident starts a new message) and `group` (the coalescing key). `destinations` are the
+# names or messengers a rule routed it to, None for every destination
+class Notification:
+    __slots__ = ('kind', 'title', 'text', 'state', 'severity', 'style', 'url', 'fields', 'dedup_key', 'account', 'region', 'time', 'message',
+                 'source', 'detail_type', 'resource', 'incident', 'resolved', 'group', 'destinations')
+
+    def __init__(self, kind, title, text=None, state=None, severity='P5', style=DEFAULT_STYLE, url=None, fields=None,
+                 dedup_key=None, account=None, region=None, time=None, message=None,
+                 source=None, detail_type=None, resource=None, incident=None, resolved=False, group=None):
+        self.kind = kind
+        self.title = title
+        self.text = text
+        self.state = state
+        self.severity = severity
+        self.style = style
+        self.url = url
+        self.fields = fields or {}
+        self.dedup_key = dedup_key or title
+        self.account = account
+        self.region = region
+        self.time = time
+        self.message = message
+        self.source = source or kind
+        self.detail_type = detail_type
+        self.resource = resource
+        self.incident = incident
+        self.resolved = resolved
+        self.group = group
+        self.destinations = None
+
+# Notification of a parsed message, built once and rendered for every messenger. RECORD_SOURCES names are kept as
+# they are, events without parser give None. The priority and destinations of a matching rule are passed to the parser
+# and set on the notification, the message itself is left untouched
+def notify(message, rule=None):
+    if isinstance(message, str):
+        return message
+    parser = classify(message)
+    if parser is None:
+        return None
+    if rule is None:
+        return parser(message)
+    notification = parser(message, rule.priority)
+    notification.destinations = rule.destinations
+    return notification
+
+def render_notification(messenger, notification):
+    if notification is None or isinstance(notification, str):
+        return notification
+    return render_template(notification.kind, messenger, notification)
+
+# ---------------------------------------------------------------------------------------------------------------------
+# RENDERERS
+# ---------------------------------------------------------------------------------------------------------------------
+# Every (notification kind, messenger) pair has a Template compiled once, when first rendered: the static skeleton is serialized
+# to bytes and only the Field values are encoded per event.
+
+encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+# Payload limits by messenger, in bytes of encoded Field values: the skeleton text is fixed and small, and most
+# messenger limits apply to the text of the message (e.g. the 6000 characters of a Discord embed)
+MESSAGE_LIMITS = {
+    'slack': 35000,
+    'discord': 6000,
+    'squadcast': 30000,
+    'msteams': 26000,
+}
+
+# Text limits of Discord embeds and Slack blocks, in characters
+DISCORD_TITLE_LIMIT = 256
+DISCORD_DESCRIPTION_LIMIT = 4096
+DISCORD_FIELD_LIMIT = 1024
+DISCORD_FOOTER_LIMIT = 2048
+SLACK_TEXT_LIMIT = 3000
+SLACK_MAX_BLOCKS = 50
+DISCORD_MAX_EMBEDS = 10
+
+# Templates split at most into MAX_PARTS messages, the remaining text is truncated
+MAX_PARTS = 5
+ELLIPSIS = '…'
 
+def truncate(text, limit):
+    if len(text) <= limit:
+        return text
+    return text[:max(limit - 1, 0)] + ELLIPSIS
+
+# Split text in parts of at most limit characters, on line breaks when possible
+def split_text(text, limit):
+    parts = list()
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    parts.append(text)
+    return parts
+
+# Paths of the text values nested in lists and dicts
+def text_paths(value, path=()):
+    if isinstance(value, str):
+        yield path
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            yield from text_paths(item, path + (key,))
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            yield from text_paths(item, path + (index,))
+
+def nested(value, path):
+    for key in path:
+        value = value[key]
+    return value
+
+# Value filled when rendering a Template, taken from the event values by name or computed by a function. Text longer
+# than `limit` characters is truncated, or split into several messages when `split` is set
+class Field:
+    __slots__ = ('source', 'limit', 'split')
+
+    def __init__(self, source, limit=None, split=False):
+        self.source = source
+        self.limit = limit
+        self.split = split
+
+    def value(self, values):
+        value = self.source(values) if callable(self.source) else getattr(values, self.source)
+        if self.limit and not self.split and isinstance(value, str):
+            return truncate(value, self.limit)
+        return value
+
+class Template:
+    def __init__(self, skeleton, max_size=None):
+        self.max_size = max_size
+        fields = list()
+
+        def mark(node):
+            if isinstance(node, Field):
+                fields.append(node)
+                return f'\x00{len(fields) - 1}\x00'
+            if isinstance(node, dict):
+                return {key: mark(value) for key, value in node.items()}
+            if isinstance(node, list):
+                return [mark(value) for value in node]
+            return node
+
+        parts = re.split(r'"\\u0000(\d+)\\u0000"', json.dumps(mark(skeleton), separators=(',', ':')))
+        self.chunks = [part.encode('utf-8') for part in parts[0::2]]
+        self.fields = [fields[int(index)] for index in parts[1::2]]
+        self.split = next((index for index, field in enumerate(self.fields) if field.split), None)
+
+    def _join(self, encoded):
+        rendered = [self.chunks[0]]
+        for value, chunk in zip(encoded, self.chunks[1:]):
+            rendered.append(value)
+            rendered.append(chunk)
+        return b''.join(rendered)
+
+    # Payload, or list of payloads when the split field had to be split. Sizes are measured on the encoded values,
+    # so only the fields being cut are encoded again
+    def render(self, values):
+        raw = [field.value(values) for field in self.fields]
+        encoded = [encoder.encode(value).encode('utf-8') for value in raw]
+        size = sum(map(len, encoded))
+        if self.split is None or not isinstance(raw[self.split], str):
+            if self.max_size and size > self.max_size:
+                self._shrink(raw, encoded, size)
+            return self._join(encoded)
+
+        field = self.fields[self.split]
+        budget = (self.max_size or size) - size + len(encoded[self.split])
+        limit = max(min(field.limit or budget, budget), 1)
+        if len(raw[self.split]) <= limit and (not self.max_size or size <= self.max_size):
+            return self._join(encoded)
+        texts = split_text(raw[self.split], limit)
+        if len(texts) > MAX_PARTS:
+            texts = texts[:MAX_PARTS - 1] + [truncate('\n'.join(texts[MAX_PARTS - 1:]), limit)]
+        payloads = list()
+        for text in texts:
+            part_raw, part_encoded = list(raw), list(encoded)
+            part_raw[self.split] = text
+            part_encoded[self.split] = encoder.encode(text).encode('utf-8')
+            part_size = size - len(encoded[self.split]) + len(part_encoded[self.split])
+            if self.max_size and part_size > self.max_size:
+                self._shrink(part_raw, part_encoded, part_size)
+            payloads.append(self._join(part_encoded))
+        return payloads[0] if len(payloads) == 1 else payloads
+
+    # Truncate the longest text values until the encoded values fit in max_size. In list and dict values (e.g. Slack
+    # blocks) the longest nested text is cut, the last one of equal lengths first
+    def _shrink(self, raw, encoded, size):
+        while size > self.max_size:
+            candidates = [index for index, value in enumerate(raw) if isinstance(value, (str, list, dict)) and len(encoded[index]) > 3]
+            texts = dict()
+            for index in candidates:
+                paths = [path for path in text_paths(raw[index]) if len(nested(raw[index], path)) > 1]
+                if paths:
+                    texts[index] = max(reversed(paths), key=lambda path: len(nested(raw[index], path)))
+            if not texts:
+                return
+            index = max(texts, key=lambda index: len(encoded[index]))
+            path = texts[index]
+            text = nested(raw[index], path)
+            # Escapes and multi-byte characters make the encoded value longer than the text, cut in proportion and
+            # leave room for the 3 bytes of the ellipsis, the next pass cuts again when that was not enough
+            encoded_text = len(encoder.encode(text).encode('utf-8'))
+            target = encoded_text - (size - self.max_size) - 3
+            keep = int(len(text) * target / encoded_text) if target > 0 else 1
+            text = truncate(text, min(max(keep, 1), len(text) - 1))
+            if path:
+                # Cut a copy, the nested values may be the notification's own
+                raw[index] = json.loads(encoded[index])
+                nested(raw[index], path[:-1])[path[-1]] = text
             else:
-                result = f'Detail type "{detail_type}" unknown, see the original event on ECS to more informations.'
-                return result
-
-        message = json.loads(event['Records'][0]['Sns']['Message'])
-        detail_type = message.get('detail-type')
-        event_id = ecs_events_parser_title(detail_type, message.get('detail'))
-        account = message.get('account')
-        time = message.get('time')
-        region = message.get('region')
-        title = ecs_events_parser_title(detail_type, message.get('detail'))
-        resources = []
-        for resource in message.get('resources'):
-            try:
-                resources.append(resource.split(':')[5])
-            except Exception:
-                log.error('Error parsing the resource ARN: `{}`'.format(resource))
-                resources.append(resource)
-        detail = ecs_events_parser(detail_type, message.get('detail'))
-        blocks = list()
-        contexts = list()
-        footer = list()
+                raw[index] = text
+            previous = len(encoded[index])
+            encoded[index] = encoder.encode(raw[index]).encode('utf-8')
+            size += len(encoded[index]) - previous
 
-        if messenger == 'slack':
-            blocks.append(
-                {
-                    'type': 'section',
-                    'text': {
-                        'type': 'mrkdwn',
-                        'text': title
-                    }
-                }
-            )
-            if resources:
-                blocks.append(
-                    {
-                        'type': 'section',
-                        'text': {
-                            'type': 'mrkdwn',
-                            'text': "*Resources*:\n" + '\n'.join(resources)
-                        }
-                    }
-                )
-            if detail:
-                blocks.append(
-                    {
-                        'type': 'section',
-                        'text': {
-                            'type': 'mrkdwn',
-                            'text': detail
+# Templates keyed by (notification kind, messenger), None keys the generic templates. Skeletons are registered at import and compiled on first use
+TEMPLATES = {}
+SKELETONS = {}
+
+def template(key, messenger, skeleton):
+    SKELETONS[(key, messenger)] = skeleton
+
+def render_template(key, messenger, values):
+    compiled = TEMPLATES.get((key, messenger))
+    if compiled is None:
+        # Kinds without templates of their own use the generic template of the messenger
+        skeleton = SKELETONS.get((key, messenger)) or SKELETONS.get((None, messenger))
+        if skeleton is None:
+            return None
+        compiled = TEMPLATES[(key, messenger)] = Template(skeleton, MESSAGE_LIMITS.get(messenger))
+    return compiled.render(values)
+
+# Microsoft Teams AdaptiveCard skeleton
+def msteams_card(style, items):
+    return {
+        "type": "message",
+        "attachments": [
+            {
+                "contentType": "application/vnd.microsoft.card.adaptive",
+                "content": {
+                    "type": "AdaptiveCard",
+                    "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
+                    "version": "1.4",
+                    "msteams": {
+                        "width": "Full"
+                    },
+                    "body": [
+                        {
+                            "type": "Container",
+                            "style": style,
+                            "items": items
                         }
-                    }
-                )
-            contexts.append({
-                'type': 'mrkdwn',
-                'text': f'Account: {account} Region: {region}'
-            })
-            contexts.append({
-                'type': 'mrkdwn',
-                'text': f'Time: {time} UTC Id: {event_id}'
-            })
-            blocks.append({
-                'type': 'context',
-                'elements': contexts
-            })
-            blocks.append({'type': 'divider'})
-            return {'blocks': blocks}
-        elif messenger == 'discord':
-            contexts.append({
-                'name': 'Resources',
-                'value': '\n'.join(resources)
-            })
-            contexts.append({
-                'name': 'Details',
-                'value': detail
-            })
-            footer.append(
-                {
-                    'text': account
+                    ],
                 }
-            )
-            blocks.append({
-                'title': title,
-                'fields': contexts,
-                'footer': {
-                    "text": f'Account: {account} | Region: {region}'
-                }
-            })
-            return {'embeds': blocks}
-
-        # Squadcast
-        elif messenger == 'squadcast':
-            message = {
-                "message": f'{title}',
-                "description": f'{detail}',
-               # "status": f"{squadcast_status}",
-                "event_id": f'{title}'
             }
-            return message
-       
-        # Microsoft Teams
-        elif messenger == 'msteams':
-            message = {
-                "type": "message",
-                "attachments": [
-                    {
-                        "contentType": "application/vnd.microsoft.card.adaptive",
-                        "content": {
-                            "type": "AdaptiveCard",
-                            "$schema":"http://adaptivecards.io/schemas/adaptive-card.json",
-                            "version": "1.4",
-                            "msteams": {  
-                                "width": "Full"  
-                            },  
-                            "body": [
-                                {
-                                    "type": "Container",
-                                    "style": "attention",
-                                    "items": [
-                                        {
-                                            "type": "TextBlock",
-                                            "size": "Large",
-                                            "weight": "Bolder",
-                                            "text": title
-                                        },
-                                        {
-                                            "type": "TextBlock",
-                                            "text": detail,
-                                            "wrap": True,
-                                        }
-                                    ]
-                                }
-                            ],
-                        }
-                    }
-                ]
+        ]
+    }
+
+def msteams_title(text):
+    return {
+        "type": "TextBlock",
+        "size": "Large",
+        "weight": "Bolder",
+        "text": text,
+    }
+
+def msteams_action(url):
+    return {
+        "type": "ActionSet",
+        "actions": [
+            {
+                "type": "Action.OpenUrl",
+                "title": "More Info",
+                "url": url
             }
-            return message
-
-    # CodeCommit
-    elif 'Records' in event and len(event['Records']) > 0 and 'eventSource' in event['Records'][0] and event['Records'][0]['eventSource'] == 'aws:codecommit':
-        return 'codecommit'
-
-    # SES
-    elif 'Records' in event and len(event['Records']) > 0 and 'eventSource' in event['Records'][0] and event['Records'][0]['eventSource'] == 'aws:ses':
-        return 'ses'
-
-    # CloudWatch
-    elif 'Records' in event and len(event['Records']) > 0 and 'EventSource' in event['Records'][0] and 'AlarmName' in event['Records'][0]['Sns']['Message']:
-        message = json.loads(event['Records'][0]['Sns']['Message'])
-        aws_account_id = message.get('AWSAccountId', None)
-        aws_region = message.get('Region', None)
-        subject = "AWS CloudWatch Notification";
-        alarmName = message.get('AlarmName')
-        metricName = message.get('Trigger', {}).get('MetricName', None)
-        oldState = message.get('OldStateValue')
-        newState = message.get('NewStateValue')
-        alarmDescription = message.get('AlarmDescription')
-        alarmReason = message.get('NewStateReason')
-        trigger = message.get('Trigger')
-        alarm_url = "https://console.aws.amazon.com/cloudwatch/home?region=" + os.environ['AWS_REGION'] + "#alarmsV2:alarm/" + urllib.parse.quote(alarmName, safe='')
-        if newState == "ALARM":
-            color = "892621"
-            squadcast_status = "trigger"
-            msteams_color = "attention"
-        elif newState == "OK":
-            color = "00c575"
-            squadcast_status = "resolve"
-            msteams_color = "good"
-
-        # Slack
-        if messenger == 'slack':
-            message = {
-                'attachments': [
-                    {
-                        'color': f'{color}',
-                        "fields": [
-                          { "value": alarmName, "short": "true" },
-                          { "value": f"{alarmDescription} (<{alarm_url}|Open>)"}
-                        ],
-                    }
-                ]
+        ]
+    }
+
+# Fields of a notification as `**label:** value` lines, Slack mrkdwn bolds with single asterisks
+def markdown_fields(v, separator=' \n', bold='**'):
+    return separator.join(f'{bold}{label}:{bold} {value}' for label, value in v.fields.items())
+
+# Generic templates, rendering the notifications of sources without templates of their own
+template(None, 'slack', {
+    'attachments': [
+        {
+            "mrkdwn_in": ["text"],
+            'fallback': Field('title'),
+            'color': Field(lambda v: f"#{v.style.color}"),
+            'title': Field('title'),
+            "text": Field(lambda v: '\n'.join(text for text in (v.text, markdown_fields(v, '\n', '*'), v.url and f"<{v.url}|Open>") if text))
+        }
+    ]
+})
+template(None, 'squadcast', {
+    "message": Field('title'),
+    "description": Field(lambda v: '\n'.join(text for text in (v.text, markdown_fields(v), v.url and f"**URL:** {v.url}", f"**Priority:** {v.severity}") if text)),
+    "status": Field(lambda v: v.style.squadcast_status),
+    "event_id": Field('dedup_key')
+})
+template(None, 'discord', {
+    'embeds': [
+        {
+            "title": Field('title', limit=DISCORD_TITLE_LIMIT),
+            "description": Field(lambda v: '\n'.join(text for text in (v.text, markdown_fields(v, '\n'), v.url and f"[Open]({v.url})") if text), limit=DISCORD_DESCRIPTION_LIMIT, split=True),
+            "color": Field(lambda v: int(v.style.color, base=16))
+        }
+    ]
+})
+template(None, 'msteams', msteams_card(Field(lambda v: v.style.msteams_color), [
+    msteams_title(Field('title')),
+    {
+        "type": "TextBlock",
+        "text": Field(lambda v: '\n\n'.join(text for text in (v.text, markdown_fields(v, ' \n\n')) if text)),
+        "wrap": True,
+    },
+]))
+
+# Codepipeline
+template('aws.codepipeline', 'slack', {
+    'attachments': [
+        {
+            "mrkdwn_in": ["text"],
+            'fallback': 'Pipeline Status',
+            'color': Field(lambda v: f"#{v.style.color}"),
+            'author_icon': 'https://www.awsgeek.com/AWS-History/icons/AWS-CodePipeline.svg',
+            "text": Field(lambda v: f"{v.title} (<{v.url}|Open>)")
+        }
+    ]
+})
+template('aws.codepipeline', 'squadcast', {
+    "message": Field('title'),
+    "description": Field(lambda v: f"{markdown_fields(v)} \n**URL:** {v.url} \n**Priority:** {v.severity}"),
+    "status": Field(lambda v: v.style.squadcast_status),
+    "event_id": Field('dedup_key')
+})
+template('aws.codepipeline', 'discord', {
+    'embeds': [
+        {
+            "title": Field('title', limit=DISCORD_TITLE_LIMIT),
+            "description": Field(lambda v: f"[Open]({v.url})", limit=DISCORD_DESCRIPTION_LIMIT),
+            "color": Field(lambda v: int(v.style.color, base=16))
+        }
+    ]
+})
+template('aws.codepipeline', 'msteams', msteams_card(Field(lambda v: v.style.msteams_color), [
+    msteams_title(Field('title')),
+    {
+        "type": "TextBlock",
+        "text": Field(lambda v: f"AWS Account: {v.account}\n\nAWS Region: {v.region}\n\nPipeline: {v.fields['Pipeline']}"),
+        "wrap": True,
+    },
+    msteams_action(Field('url')),
+]))
+
+# CodeBuild
+template('aws.codebuild', 'slack', {
+    'attachments': [
+        {
+            "mrkdwn_in": ["text"],
+            'fallback': 'Pipeline Status',
+            'color': Field(lambda v: f"#{v.style.color}"),
+            'author_icon': 'https://www.awsgeek.com/AWS-History/icons/AWS-CodeBuild.svg',
+            "text": Field(lambda v: f"Codebuild {v.fields['Project']} {v.style.status} (<{v.url}|Open>)")
+        }
+    ]
+})
+template('aws.codebuild', 'squadcast', {
+    "message": Field('title'),
+    "description": Field(lambda v: f"{markdown_fields(v)} \n**URL:** {v.url} \n**Priority:** {v.severity}"),
+    "status": Field(lambda v: v.style.squadcast_status),
+    "event_id": Field('dedup_key')
+})
+template('aws.codebuild', 'discord', {
+    'embeds': [
+        {
+            "title": Field('title', limit=DISCORD_TITLE_LIMIT),
+            "description": Field(lambda v: f"[Open]({v.url})", limit=DISCORD_DESCRIPTION_LIMIT),
+            "color": Field(lambda v: int(v.style.color, base=16))
+        }
+    ]
+})
+template('aws.codebuild', 'msteams', msteams_card(Field(lambda v: v.style.msteams_color), [
+    msteams_title(Field(lambda v: f"CodeBuild Summary {v.fields['Project']} {v.style.status}")),
+    {
+        "type": "TextBlock",
+        "text": Field(lambda v: markdown_fields(v, ' \n\n') + f" \n\n**Priority:** {v.severity}"),
+        "wrap": True,
+    },
+    msteams_action(Field('url')),
+]))
+
+# ECS
+def ecs_slack_blocks(v):
+    blocks = [
+        {
+            'type': 'section',
+            'text': {
+                'type': 'mrkdwn',
+                'text': truncate(v.title, SLACK_TEXT_LIMIT)
             }
-            return message
-
-        # Squadcast
-        elif messenger == 'squadcast':
-            message = {
-                "message": alarmName,
-                "description": f"{alarmDescription} \n**URL:** {alarm_url} \n**Message:** {message}\n**Priority:** P5",
-                "status": f"{squadcast_status}",
-                "event_id": alarmName
+        }
+    ]
+    if v.fields['Resources']:
+        blocks.append(
+            {
+                'type': 'section',
+                'text': {
+                    'type': 'mrkdwn',
+                    'text': truncate("*Resources*:\n" + '\n'.join(v.fields['Resources']), SLACK_TEXT_LIMIT)
+                }
             }
-            return message
-
-        # Discord
-        elif messenger == 'discord':
-            color = int(color, base=16)
-            message = {
-                'embeds': [
-                    {
-                        "title": alarmName,
-                        "description": f"{alarmDescription} [Open]({alarm_url})",
-                        "color": color
-                    }
-                ]
+        )
+    # Long details take several sections, within the block limit with the context and divider blocks
+    details = split_text(v.text, SLACK_TEXT_LIMIT) if v.text else []
+    room = SLACK_MAX_BLOCKS - len(blocks) - 2
+    if len(details) > room:
+        details = details[:room - 1] + [truncate('\n'.join(details[room - 1:]), SLACK_TEXT_LIMIT)]
+    for detail in details:
+        blocks.append(
+            {
+                'type': 'section',
+                'text': {
+                    'type': 'mrkdwn',
+                    'text': detail
+                }
             }
-            return message
-
-        # Microsoft Teams
-        elif messenger == 'msteams':
-            message = {
-                "type": "message",
-                "attachments": [
-                    {
-                        "contentType": "application/vnd.microsoft.card.adaptive",
-                        "content": {
-                            "type": "AdaptiveCard",
-                            "$schema":"http://adaptivecards.io/schemas/adaptive-card.json",
-                            "version": "1.4",
-                            "msteams": {  
-                                "width": "Full"  
-                            },  
-                            "body": [
-                                {
-                                    "type": "Container",
-                                    "style": msteams_color,
-                                    "items": [
-                                        {
-                                            "type": "TextBlock",
-                                            "size": "Large",
-                                            "weight": "Bolder",
-                                            "text": alarmName,
-                                        },
-                                        {
-                                            "type": "TextBlock",
-                                            "text": f"**AWS Account:** {aws_account_id} \n\n **AWS Region:** {aws_region} \n\n **Description:** {alarmDescription} \n\n**State**: {newState}",
-                                            "wrap": "true",
-                                        },
-                                        {
-                                            "type": "ActionSet",
-                                            "actions": [
-                                                {
-                                                    "type": "Action.OpenUrl",
-                                                    "title": "More Info",
-                                                    "url": alarm_url
-                                                }
-                                            ]
-                                        }
-                                    ]
-                                }
-                            ],
-                        }
-                    }
-                ]
+        )
+    blocks.append({
+        'type': 'context',
+        'elements': [
+            {
+                'type': 'mrkdwn',
+                'text': f"Account: {v.account} Region: {v.region}"
+            },
+            {
+                'type': 'mrkdwn',
+                'text': f"Time: {v.time} UTC Id: {v.dedup_key}"
             }
-            return message
-        
-# Post Webhook
-def post(WEBHOOK_URL, message):
-    log.debug(f'Sending message: {json.dumps(message, indent=4)}')
-    headers = {'Content-type': 'application/json'}
-    response = requests.post(WEBHOOK_URL, json.dumps(message), headers=headers)
-    log.debug('Response: {}, message: {}'.format(response.status_code, response.text))
-    return response.status_code
+        ]
+    })
+    blocks.append({'type': 'divider'})
+    return blocks
+
+template('aws.ecs', 'slack', {'blocks': Field(ecs_slack_blocks)})
+template('aws.ecs', 'discord', {
+    'embeds': [
+        {
+            'title': Field('title', limit=DISCORD_TITLE_LIMIT),
+            'fields': [
+                {
+                    'name': 'Resources',
+                    'value': Field(lambda v: '\n'.join(v.fields['Resources']), limit=DISCORD_FIELD_LIMIT)
+                },
+                {
+                    'name': 'Details',
+                    'value': Field('text', limit=DISCORD_FIELD_LIMIT, split=True)
+                }
+            ],
+            'footer': {
+                "text": Field(lambda v: f"Account: {v.account} | Region: {v.region}", limit=DISCORD_FOOTER_LIMIT)
+            }
+        }
+    ]
+})
+template('aws.ecs', 'squadcast', {
+    "message": Field(lambda v: f"{v.title}"),
+    "description": Field(lambda v: f"{v.text}"),
+    "event_id": Field(lambda v: f"{v.dedup_key}")
+})
+template('aws.ecs', 'msteams', msteams_card("attention", [
+    msteams_title(Field('title')),
+    {
+        "type": "TextBlock",
+        "text": Field('text'),
+        "wrap": True,
+    }
+]))
+
+# CloudWatch
+template(CLOUDWATCH_ALARM, 'slack', {
+    'attachments': [
+        {
+            'color': Field(lambda v: f"{v.style.color}"),
+            "fields": [
+                {"value": Field('title'), "short": "true"},
+                {"value": Field(lambda v: f"{v.text} (<{v.url}|Open>)")}
+            ],
+        }
+    ]
+})
+template(CLOUDWATCH_ALARM, 'squadcast', {
+    "message": Field('title'),
+    "description": Field(lambda v: f"{v.text} \n**URL:** {v.url} \n**Message:** {v.message}\n**Priority:** {v.severity}" + (f"\n**Tags:** {v.fields['Tags']}" if 'Tags' in v.fields else '')),
+    "status": Field(lambda v: v.style.squadcast_status),
+    "event_id": Field('dedup_key')
+})
+template(CLOUDWATCH_ALARM, 'discord', {
+    'embeds': [
+        {
+            "title": Field('title', limit=DISCORD_TITLE_LIMIT),
+            "description": Field(lambda v: f"{v.text} [Open]({v.url})", limit=DISCORD_DESCRIPTION_LIMIT),
+            "color": Field(lambda v: int(v.style.color, base=16))
+        }
+    ]
+})
+template(CLOUDWATCH_ALARM, 'msteams', msteams_card(Field(lambda v: v.style.msteams_color), [
+    msteams_title(Field('title')),
+    {
+        "type": "TextBlock",
+        "text": Field(lambda v: f"**AWS Account:** {v.account} \n\n **AWS Region:** {v.fields['AWS Region']} \n\n **Description:** {v.text} \n\n**State**: {v.state}" + (f" \n\n**Tags**: {v.fields['Tags']}" if 'Tags' in v.fields else '')),
+        "wrap": "true",
+    },
+    msteams_action(Field('url')),
+]))
+
+# ---------------------------------------------------------------------------------------------------------------------
+# EVENT HANDLERS
+# ---------------------------------------------------------------------------------------------------------------------
+
+# Console URL of an alarm, pipeline or build project
+def console_url(service, region, name):
+    if service == 'cloudwatch':
+        return alarm_url(region, name)
+    return f'https://{region}.console.aws.amazon.com/codesuite/{service}/pipelines/{name}/view?region={region}'
+
+# Quoting the alarm name costs more than a cache lookup
+@lru_cache(maxsize=MEMO_CACHE_SIZE)
+def alarm_url(region, name):
+    return f"https://console.aws.amazon.com/cloudwatch/home?region={region}#alarmsV2:alarm/{urllib.parse.quote(name, safe='')}"
+
+# Codepipeline
+@event_handler('aws.codepipeline')
+def parse_codepipeline(message: dict, priority=None):
+    aws_region = message.get('region', None)
+    detail = message.get('detail', {})
+    pipeline = detail.get('pipeline', None)
+    style = state_style('aws.codepipeline', detail.get('state', None))
+    return Notification(
+        'aws.codepipeline',
+        f'CodePipeline {pipeline} {style.status}',
+        state=detail.get('state'),
+        severity=priority or style.severity,
+        style=style,
+        url=console_url('codepipeline', aws_region, pipeline),
+        fields={'AWS Account': message.get('account', None), 'AWS Region': aws_region, 'Pipeline': pipeline, 'Status': style.status},
+        account=message.get('account', None),
+        region=aws_region,
+        time=message.get('time'),
+        message=message,
+        detail_type=message.get('detail-type'),
+        resource=pipeline,
+        incident=detail.get('execution-id'),
+        group=f'CodePipeline {pipeline}',
+    )
+
+# CodeBuild
+@event_handler('aws.codebuild')
+def parse_codebuild(message: dict, priority=None):
+    aws_region = message.get('region', None)
+    detail = message.get('detail', {})
+    project_name = detail.get('project-name', None)
+    style = state_style('aws.codebuild', detail.get('build-status', None))
+    return Notification(
+        'aws.codebuild',
+        f'CodeBuild {project_name} {style.status}',
+        state=detail.get('build-status'),
+        severity=priority or style.severity,
+        style=style,
+        url=console_url('codebuild', aws_region, project_name),
+        fields={'AWS Account': message.get('account', None), 'AWS Region': aws_region, 'Project': project_name, 'Status': style.status},
+        account=message.get('account', None),
+        region=aws_region,
+        time=message.get('time'),
+        message=message,
+        detail_type=message.get('detail-type'),
+        resource=project_name,
+        incident=detail.get('build-id'),
+        group=f'CodeBuild {project_name}',
+    )
+
+# ECS
+Arn = namedtuple('Arn', ('partition', 'service', 'region', 'account', 'resource', 'path'))
+
+# Parse an ARN once, cluster, task definition and container instance ARNs repeat across events
+@lru_cache(maxsize=MEMO_CACHE_SIZE)
+def parse_arn(arn):
+    parts = arn.split(':', 5)
+    if len(parts) < 6 or parts[0] != 'arn':
+        return None
+    return Arn(parts[1], parts[2], parts[3], parts[4], parts[5], tuple(parts[5].split('/')))
+
+# Resource of an ARN, the ARN itself when it can not be parsed
+def arn_resource(arn):
+    parsed = parse_arn(arn)
+    if parsed is None:
+        log.error('Error parsing the resource ARN: `{}`'.format(arn))
+        return arn
+    return parsed.resource
+
+# Segment of the ARN resource path, e.g. the task definition of `task-definition/name:revision`. Container
+# instance and task ARNs have the cluster in the path since the ECS long ARN format, their ID is the last segment
+def arn_segment(arn, index):
+    if arn is None:
+        return None
+    parsed = parse_arn(arn)
+    if parsed is None or len(parsed.path) <= max(index, 1):
+        log.error('Error parsing ARN: `{}`'.format(arn))
+        return arn
+    return parsed.path[index]
+
+# Header and (label, value) fields of an ECS event detail, by detail type. Fields without label are plain bullets
+def ecs_container_instance_fields(detail, message, severity):
+    instance = detail.get('ec2InstanceId') or arn_segment(detail.get('containerInstanceArn'), -1) or 'UNKNOWN'
+    return f'*Instance ID:* {instance}', [
+        ('Status', detail.get('status')),
+        ('Reason', detail.get('statusReason')),
+    ]
+
+def ecs_deployment_fields(detail, message, severity):
+    return '*Event Detail:*', [
+        (None, f"{detail.get('eventType')} - {detail.get('eventName')}"),
+        ('Deployment', detail.get('deploymentId')),
+        ('Reason', detail.get('reason')),
+    ]
+
+def ecs_service_action_fields(detail, message, severity):
+    capacity_providers = [arn_segment(arn, 1) for arn in detail.get('capacityProviderArns', [])]
+    return '*Event Detail:*', [
+        (None, f"{detail.get('eventType')} - {detail.get('eventName')}"),
+        ('Capacity Providers', ', '.join(capacity_providers) or None),
+    ]
+
+def ecs_task_fields(detail, message, severity):
+    last_status = detail.get('lastStatus')
+    return '*Event Detail:*', [
+        ('Region', message.get('region')),
+        ('Cluster', detail.get('clusterArn')),
+        ('Task Definition', arn_segment(detail.get('taskDefinitionArn'), 1)),
+        ('Last', last_status),
+        ('Desired', detail.get('desiredStatus')),
+        ('Priority', f'({severity})'),
+        ('Instance ID', arn_segment(detail.get('containerInstanceArn'), -1)),
+        ('HealthStatus', detail.get('healthStatus') if last_status == 'RUNNING' else None),
+        ('Stop Code', detail.get('stopCode') if last_status == 'STOPPED' else None),
+        ('Stop Reason', detail.get('stoppedReason') if last_status == 'STOPPED' else None),
+    ]
+
+# Other detail types list their top level scalar values, ARNs shortened to their resource
+ECS_GENERIC_MAX_FIELDS = 10
+
+def ecs_generic_fields(detail, message, severity):
+    fields = list()
+    for key, value in detail.items():
+        if not isinstance(value, (str, int, float)):
+            continue
+        if isinstance(value, str) and value.startswith('arn:'):
+            value = arn_resource(value)
+        fields.append((key, value))
+        if len(fields) == ECS_GENERIC_MAX_FIELDS:
+            break
+    return '*Event Detail:*', fields
+
+ECS_DETAILS = {
+    'ECS Container Instance State Change': ecs_container_instance_fields,
+    'ECS Deployment State Change': ecs_deployment_fields,
+    'ECS Service Action': ecs_service_action_fields,
+    'ECS Task State Change': ecs_task_fields,
+}
+
+# Detail text of an ECS event, assembled in a single pass and shared by every messenger
+def ecs_detail(detail_type, detail, message, severity):
+    header, fields = ECS_DETAILS.get(detail_type, ecs_generic_fields)(detail, message, severity)
+    lines = [header]
+    for label, value in fields:
+        if value is not None:
+            lines.append(f'• {value}' if label is None else f'• {label}: {value}')
+    return '\n'.join(lines)
+
+def ecs_title(detail_type, detail):
+    if detail_type == 'ECS Task State Change':
+        return f"{detail.get('stoppedReason', 'UNKNOWN')} on {detail.get('group', 'UNKNOWN')}"
+    return detail_type or 'ECS Event'
+
+@event_handler('aws.ecs')
+def parse_ecs(message: dict, priority=None):
+    detail_type = message.get('detail-type')
+    detail = message.get('detail') or {}
+
+    return Notification(
+        'aws.ecs',
+        ecs_title(detail_type, detail),
+        text=ecs_detail(detail_type, detail, message, priority or 'P3'),
+        state=detail.get('lastStatus') or detail.get('eventName') or detail.get('status'),
+        severity=priority or 'P3',
+        fields={'Resources': [arn_resource(resource) for resource in message.get('resources', [])]},
+        account=message.get('account'),
+        region=message.get('region'),
+        time=message.get('time'),
+        message=message,
+        detail_type=detail_type,
+        resource=detail.get('taskArn') or detail.get('group') or ','.join(message.get('resources', [])),
+        group=f"{detail_type} {detail.get('group') or detail.get('clusterArn')}",
+    )
+
+# CloudWatch
+cloudwatch_client = None
+
+# Description and tags of an alarm from the CloudWatch API, fetched when ALARM_METADATA is enabled
+@memoized(alarm_metadata_cache)
+def alarm_metadata(alarm_name, alarm_arn):
+    global cloudwatch_client
+    if cloudwatch_client is None:
+        import boto3
+        cloudwatch_client = boto3.client('cloudwatch')
+    alarms = cloudwatch_client.describe_alarms(AlarmNames=[alarm_name])
+    found = alarms.get('MetricAlarms', []) + alarms.get('CompositeAlarms', [])
+    description = found[0].get('AlarmDescription') if found else None
+    tags = dict()
+    if alarm_arn:
+        tags = {tag['Key']: tag['Value'] for tag in cloudwatch_client.list_tags_for_resource(ResourceARN=alarm_arn).get('Tags', [])}
+    return description, tags
+
+@event_handler(CLOUDWATCH_ALARM)
+def parse_cloudwatch(message: dict, priority=None):
+    alarmName = message.get('AlarmName')
+    newState = message.get('NewStateValue')
+    style = state_style('aws.cloudwatch', newState)
+    # SNS notifications name the region, e.g. `US East (N. Virginia)`, the ARN has its code
+    arn = parse_arn(message['AlarmArn']) if message.get('AlarmArn') else None
+    description = message.get('AlarmDescription')
+    fields = {'AWS Account': message.get('AWSAccountId', None), 'AWS Region': message.get('Region', None), 'State': newState}
+    if ALARM_METADATA:
+        try:
+            fetched, tags = alarm_metadata(alarmName, message.get('AlarmArn'))
+            description = description or fetched
+            if tags:
+                fields['Tags'] = ', '.join(f'{key}={value}' for key, value in tags.items())
+        except Exception:
+            log.warning('Error fetching the metadata of alarm `{}`'.format(alarmName), exc_info=True)
+    return Notification(
+        CLOUDWATCH_ALARM,
+        alarmName,
+        text=description,
+        state=newState,
+        severity=priority or style.severity,
+        style=style,
+        # In aggregation mode alarms come from other regions than the function's
+        url=console_url('cloudwatch', arn.region if arn else AWS_REGION, alarmName),
+        fields=fields,
+        account=message.get('AWSAccountId', None),
+        region=arn.region if arn else None,
+        time=message.get('StateChangeTime'),
+        message=message,
+        source='aws.cloudwatch',
+        resource=alarmName,
+        incident=message.get('AlarmArn') or alarmName,
+        resolved=style.squadcast_status == 'resolve',
+        group=alarmName,
+    )
+
+# HTTP status codes worth retrying
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Methods whose request is not sent again once fully written, the server may have processed it
+NON_IDEMPOTENT_METHODS = ('POST', 'PATCH')
+
+# No response in time to a request fully written
+class ResponseTimeout(Exception):
+    pass
+
+# Pooled keep-alive HTTP client, reused across warm invocations
+class HTTPClient:
+    def __init__(self, connect_timeout, read_timeout, total_timeout, max_retries, backoff_base, backoff_max):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.total_timeout = total_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._pool = {}
+        self._lock = threading.Lock()
+
+    # Socket timeout of an attempt, cut to the time left before the deadline of the request
+    def _timeout(self, timeout, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout(f'No time left of the {self.total_timeout}s total timeout')
+        return min(timeout, remaining)
+
+    def _acquire(self, scheme, host, port, deadline):
+        connect_timeout = self._timeout(self.connect_timeout, deadline)
+        read_timeout = self._timeout(self.read_timeout, deadline)
+        with self._lock:
+            idle = self._pool.get((scheme, host, port))
+            connection = idle.pop() if idle else None
+        if connection is not None:
+            connection.sock.settimeout(read_timeout)
+            return connection, True
+        connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        connection = connection_class(host, port, timeout=connect_timeout)
+        connection.connect()
+        connection.sock.settimeout(self._timeout(self.read_timeout, deadline))
+        return connection, False
+
+    def _release(self, scheme, host, port, connection):
+        with self._lock:
+            self._pool.setdefault((scheme, host, port), []).append(connection)
+
+    def _acquire_new(self, scheme, host, port, deadline):
+        with self._lock:
+            for connection in self._pool.pop((scheme, host, port), []):
+                connection.close()
+        return self._acquire(scheme, host, port, deadline)
+
+    def _exchange(self, connection, method, path, body, headers):
+        try:
+            connection.request(method, path, body, headers)
+        except Exception:
+            connection.close()
+            raise
+        try:
+            response = connection.getresponse()
+            return response, response.read()
+        except socket.timeout:
+            connection.close()
+            if method in NON_IDEMPOTENT_METHODS:
+                # The path of a webhook URL is its secret, only the host is named
+                raise ResponseTimeout(f'No response in time to {method} {connection.host}')
+            raise
+        except Exception:
+            connection.close()
+            raise
+
+    def _send(self, method, url, body, headers, deadline):
+        parsed = urllib.parse.urlsplit(url)
+        path = parsed.path or '/'
+        if parsed.query:
+            path = f'{path}?{parsed.query}'
+        scheme, host, port = parsed.scheme, parsed.hostname, parsed.port
+        connection, reused = self._acquire(scheme, host, port, deadline)
+        try:
+            response, data = self._exchange(connection, method, path, body, headers)
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            if not reused:
+                raise
+            # The server closed an idle keep-alive connection, retry once on a fresh one
+            connection, reused = self._acquire_new(scheme, host, port, deadline)
+            response, data = self._exchange(connection, method, path, body, headers)
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(scheme, host, port, connection)
+        return response.status, response.headers, data
+
+    def _backoff(self, attempt, headers):
+        if headers is not None and headers.get('Retry-After'):
+            retry_after = headers['Retry-After']
+            try:
+                return max(float(retry_after), 0)
+            except ValueError:
+                # Only needed for HTTP-date values, which are rare
+                from email.utils import parsedate_to_datetime
+                try:
+                    return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0)
+                except (TypeError, ValueError):
+                    pass
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    # Send with retries until the total timeout, or the earlier deadline given by the caller
+    def request(self, method, url, body=None, headers=None, deadline=None):
+        deadline = min(time.monotonic() + self.total_timeout, deadline or float('inf'))
+        attempt = 0
+        while True:
+            response_headers = None
+            try:
+                status, response_headers, data = self._send(method, url, body, headers or {}, deadline)
+                if status not in RETRY_STATUS_CODES:
+                    return status, data
+                error = None
+            except (OSError, http.client.HTTPException) as exception:
+                status, data, error = None, None, exception
+            delay = self._backoff(attempt, response_headers)
+            if attempt >= self.max_retries or time.monotonic() + delay >= deadline:
+                if error is not None:
+                    raise error
+                return status, data
+            attempt += 1
+            log.warning('Retrying request in {:.2f}s (attempt {}), status: `{}`, error: `{}`'.format(delay, attempt, status, error))
+            metrics.put('Retries', 1)
+            time.sleep(delay)
+
+HTTP_CLIENT = HTTPClient(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, HTTP_TOTAL_TIMEOUT, HTTP_MAX_RETRIES, HTTP_BACKOFF_BASE, HTTP_BACKOFF_MAX)
+
+# Default rate limits by messenger, in messages per second with bursts of `burst` messages
+DEFAULT_RATE_LIMITS = {
+    'slack': {'rate': 1, 'burst': 3},
+    'discord': {'rate': 2.5, 'burst': 5},
+    'msteams': {'rate': 4, 'burst': 4},
+    'squadcast': {'rate': 10, 'burst': 10},
+}
+
+class RateLimited(Exception):
+    pass
+
+# Seconds of the invocation kept once the deliveries are over, to save the retries and report the results
+DELIVERY_TIME_MARGIN = 2
+
+# Deadline of the deliveries of an invocation, rate limit waits and HTTP retries included. HTTP_TOTAL_TIMEOUT, cut to
+# the time the function has left to run
+def delivery_deadline(context):
+    budget = HTTP_TOTAL_TIMEOUT
+    if hasattr(context, 'get_remaining_time_in_millis'):
+        budget = min(budget, context.get_remaining_time_in_millis() / 1000 - DELIVERY_TIME_MARGIN)
+    return time.monotonic() + budget
+
+# Token bucket, sends wait for a token up to max_wait seconds instead of hitting the webhook 429s
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    # Reserve a token, returns the seconds to wait for it or None when that is more than max_wait
+    def reserve(self, max_wait):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0
+            if wait > max_wait:
+                return None
+            # Concurrent senders queue behind the reserved token
+            self.tokens -= 1
+            return wait
+
+    def acquire(self, max_wait):
+        wait = self.reserve(max_wait)
+        if wait is None:
+            return False
+        if wait > 0:
+            log.debug('Rate limited, waiting %.2fs', wait)
+            time.sleep(wait)
+        return True
+
+# Token buckets by webhook URL, kept by the warm container
+rate_limiters = dict()
+rate_limiters_lock = threading.Lock()
+
+def rate_limiter(messenger, webhook_url):
+    with rate_limiters_lock:
+        if webhook_url not in rate_limiters:
+            limits = {**DEFAULT_RATE_LIMITS.get(messenger, {'rate': 10, 'burst': 10}), **RATE_LIMITS.get(messenger, {})}
+            rate_limiters[webhook_url] = TokenBucket(limits['rate'], limits['burst'])
+        return rate_limiters[webhook_url]
+
+WEBHOOK_HEADERS = {'Content-type': 'application/json'}
+
+# Request body of a rendered payload or a dict
+def request_body(message):
+    body = message if isinstance(message, bytes) else encoder.encode(message).encode('utf-8')
+    log.debug('Sending message: %s', Lazy(lambda: body.decode('utf-8')))
+    return body
+
+# Post Webhook, message is a rendered payload or a dict
+def post(WEBHOOK_URL, message, deadline=None):
+    status, data = HTTP_CLIENT.request('POST', WEBHOOK_URL, request_body(message), WEBHOOK_HEADERS, deadline)
+    log.debug('Response: %s, message: %s', status, data)
+    return status
+
+# Identifier of a SNS or SQS record
+def record_id(record: dict):
+    if 'Sns' in record:
+        return record['Sns'].get('MessageId')
+    return record.get('messageId')
+
+# Source of the event, used by destination filters and metrics. RECORD_SOURCES names are their own source
+def notification_source(notification):
+    if isinstance(notification, Notification):
+        return notification.source
+    return notification
+
+# Check the destinations a rule routed the message to, then the destination filter, a list of event sources or detail types
+def destination_accepts(destination: dict, notification):
+    parsed = isinstance(notification, Notification)
+    if parsed and notification.destinations is not None:
+        if destination.get('name') not in notification.destinations and destination['messenger'] not in notification.destinations:
+            return False
+    accepted = destination.get('filter')
+    if not accepted:
+        return True
+    if notification_source(notification) in accepted:
+        return True
+    return parsed and notification.detail_type in accepted
+
+# Build delivery jobs for the destinations accepting the notification, rendering once per messenger
+def destination_jobs(notification, render_messenger):
+    rendered = dict()
+    jobs = list()
+    key = lifecycle_key(notification)
+    for destination in notification_destinations(notification):
+        if not destination_accepts(destination, notification):
+            continue
+        messenger = destination['messenger']
+        if messenger not in rendered:
+            started = time.perf_counter()
+            payload = render_messenger(messenger)
+            meta = {'source': notification_source(notification), 'render_ms': round((time.perf_counter() - started) * 1000, 3)}
+            rendered[messenger] = payload, meta
+            metrics.put('RenderTime', meta['render_ms'], messenger=messenger, source=meta['source'])
+            for part in payload if isinstance(payload, list) else [payload]:
+                if isinstance(part, bytes):
+                    metrics.put('PayloadBytes', len(part), messenger=messenger, source=meta['source'])
+        payload, meta = rendered[messenger]
+        if isinstance(payload, (bytes, dict)):
+            if key is not None and lifecycle_supported(destination):
+                meta = {**meta, 'lifecycle': (lifecycle_reference_key(key, destination), destination, notification.resolved)}
+            jobs.append((messenger, destination['webhook_url'], payload, meta))
+        elif isinstance(payload, list):
+            # Oversized messages split by their template
+            jobs.extend((messenger, destination['webhook_url'], part, meta) for part in payload)
+    return jobs
+
+# Thread pool used to deliver to several webhooks concurrently, created on first use
+executor = None
+
+# Deadline of the deliveries running, set by deliver
+current_deadline = None
+
+# Rate limit wait of a delivery, RATE_LIMIT_MAX_WAIT cut to the time left before the deadline
+def rate_limit_wait():
+    if current_deadline is None:
+        return RATE_LIMIT_MAX_WAIT
+    return max(min(RATE_LIMIT_MAX_WAIT, current_deadline - time.monotonic()), 0)
+
+# Post to webhook once the destination rate limit allows it, returns the status code or the raised exception
+def deliver_one(messenger, webhook_url, message, meta=None):
+    metrics.dimensions.set({'messenger': messenger, 'source': (meta or {}).get('source')})
+    try:
+        max_wait = rate_limit_wait()
+        if not rate_limiter(messenger, webhook_url).acquire(max_wait):
+            raise RateLimited(f'Rate limit of {messenger} webhook exceeded, waiting more than {max_wait:.1f}s')
+        webhook_url = webhook_secrets.resolve(webhook_url)
+        started = time.perf_counter()
+        if (meta or {}).get('lifecycle') is not None:
+            status = post_lifecycle(messenger, webhook_url, message, *meta['lifecycle'], current_deadline)
+        else:
+            status = post(webhook_url, message, current_deadline)
+        log_delivery(messenger, status, meta, started)
+        return status
+    except Exception as exception:
+        metrics.put('DeliveryErrors', 1)
+        return exception
+
+# Log and measure a delivery, the metric dimensions are set by the caller
+def log_delivery(messenger, status, meta, started):
+    http_ms = round((time.perf_counter() - started) * 1000, 3)
+    metrics.put('HttpTime', http_ms)
+    metrics.put(f'Http{status // 100}xx', 1)
+    if log.isEnabledFor(DELIVERY_LOG_LEVEL):
+        meta = meta or {}
+        log.log(DELIVERY_LOG_LEVEL, 'Delivered `%s` notification, status: `%s`, render: %sms, http: %sms',
+                messenger, status, meta.get('render_ms'), http_ms,
+                extra={'messenger': messenger, 'status': status, 'http_ms': http_ms, **meta})
+
+# asyncio HTTP client, created with the async_delivery module on first use
+async_client = None
+
+# Coroutine of deliver_one, for the async delivery path
+async def deliver_one_async(messenger, webhook_url, message, meta=None):
+    import async_delivery
+    metrics.dimensions.set({'messenger': messenger, 'source': (meta or {}).get('source')})
+    try:
+        max_wait = rate_limit_wait()
+        wait = rate_limiter(messenger, webhook_url).reserve(max_wait)
+        if wait is None:
+            raise RateLimited(f'Rate limit of {messenger} webhook exceeded, waiting more than {max_wait:.1f}s')
+        if wait > 0:
+            await async_delivery.asyncio.sleep(wait)
+        # Cached after the first invocation, the KMS or Secrets Manager lookup is not worth a thread
+        webhook_url = webhook_secrets.resolve(webhook_url)
+        started = time.perf_counter()
+        if (meta or {}).get('lifecycle') is not None:
+            status = await post_lifecycle_async(messenger, webhook_url, message, *meta['lifecycle'], current_deadline)
+        else:
+            status, data = await async_client.request('POST', webhook_url, request_body(message), WEBHOOK_HEADERS, current_deadline)
+            log.debug('Response: %s, message: %s', status, data)
+        log_delivery(messenger, status, meta, started)
+        return status
+    except Exception as exception:
+        metrics.put('DeliveryErrors', 1)
+        return exception
+
+async def deliver_chain_async(*jobs):
+    return [await deliver_one_async(*job) for job in jobs]
+
+# Deliver chains of jobs on the asyncio event loop, at most DELIVERY_MAX_WORKERS requests in flight
+def deliver_async(chains):
+    global async_client
+    import async_delivery
+    if async_client is None:
+        async_client = async_delivery.AsyncHTTPClient(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, HTTP_TOTAL_TIMEOUT, HTTP_MAX_RETRIES, HTTP_CLIENT._backoff, RETRY_STATUS_CODES)
+    return async_delivery.deliver(chains, deliver_chain_async, DELIVERY_MAX_WORKERS)
+
+def deliver_chain(jobs):
+    return [deliver_one(*job) for job in jobs]
+
+# Indexes of the jobs delivered one after the other. The jobs of a same lifecycle message are chained in their order,
+# the first one posts the message and the next ones update it
+def job_chains(jobs):
+    chains = list()
+    lifecycles = dict()
+    for index, job in enumerate(jobs):
+        reference = (job[3] or {}).get('lifecycle')
+        if reference is None:
+            chains.append([index])
+        elif reference[0] in lifecycles:
+            lifecycles[reference[0]].append(index)
+        else:
+            lifecycles[reference[0]] = [index]
+            chains.append(lifecycles[reference[0]])
+    return chains
+
+# Deliver (messenger, webhook_url, message, meta) jobs, concurrently when there is more than one chain, until the
+# deadline when one is given
+def deliver(jobs, deadline=None):
+    global current_deadline
+    current_deadline = deadline
+    try:
+        return deliver_chains(jobs)
+    finally:
+        current_deadline = None
+
+def deliver_chains(jobs):
+    global executor
+    if len(jobs) <= 1:
+        return [deliver_one(*job) for job in jobs]
+    chains = job_chains(jobs)
+    chained = [[jobs[index] for index in chain] for chain in chains]
+    if len(chained) == 1:
+        results = [deliver_chain(chained[0])]
+    elif DELIVERY_MODE == 'async':
+        results = deliver_async(chained)
+    else:
+        if executor is None:
+            # Single destination setups never fan out, so the thread pool is only imported when needed
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor(max_workers=DELIVERY_MAX_WORKERS)
+        results = executor.map(deliver_chain, chained)
+    responses = [None] * len(jobs)
+    for chain, chain_responses in zip(chains, results):
+        for index, response in zip(chain, chain_responses):
+            responses[index] = response
+    return responses
+
+# ---------------------------------------------------------------------------------------------------------------------
+# LIFECYCLE
+# ---------------------------------------------------------------------------------------------------------------------
+# With LIFECYCLE_STORE set, the notifications of a same alarm, pipeline execution or build update the message posted
+# for the first one instead of posting new messages. Discord webhooks edit it. Slack destinations with a bot `token`
+# and a `channel` post with the Web API and update it with chat.update, or reply in its thread when their `lifecycle`
+# is `thread`. Incoming webhooks of the other messengers can not edit messages and keep posting new ones, as do
+# split messages and retries from the outbox. A resolved alarm ends its message, so the next ALARM notifies again
+# with a new one. The jobs of a same message are delivered in order, one after the other.
+
+# Slack API errors of a message that was deleted, a new one is posted instead
+SLACK_MISSING_MESSAGE_ERRORS = ('message_not_found', 'thread_not_found', 'cant_update_message')
+
+lifecycle_store = None
+
+def get_lifecycle_store():
+    global lifecycle_store
+    if lifecycle_store is None:
+        lifecycle_store = lifecycle.create_lifecycle_store(LIFECYCLE_STORE)
+    return lifecycle_store
+
+# Key of the lifecycle a notification belongs to, None for notifications standing on their own
+def lifecycle_key(notification):
+    if not LIFECYCLE_STORE or not isinstance(notification, Notification) or not notification.incident:
+        return None
+    return f'{notification.source}:{notification.incident}'
+
+def lifecycle_supported(destination: dict):
+    if destination['messenger'] == 'discord':
+        return True
+    return destination['messenger'] == 'slack' and bool(destination.get('token')) and bool(destination.get('channel'))
+
+# Key of the message reference of a lifecycle for a destination
+def lifecycle_reference_key(key, destination: dict):
+    return f"{key}:{destination.get('name') or uuid.uuid5(uuid.NAMESPACE_URL, destination['webhook_url']).hex}"
+
+# Request (method, url, body, headers) posting the message of a lifecycle, or updating the referenced one
+def lifecycle_request(messenger, webhook_url, message, destination, reference):
+    if messenger == 'discord':
+        url, _, query = webhook_url.partition('?')
+        if reference is None:
+            return 'POST', f"{url}?{query + '&' if query else ''}wait=true", request_body(message), WEBHOOK_HEADERS
+        return 'PATCH', f"{url}/messages/{reference['id']}{'?' + query if query else ''}", request_body(message), WEBHOOK_HEADERS
+    payload = json.loads(message) if isinstance(message, bytes) else dict(message)
+    payload['channel'] = destination['channel']
+    method = 'chat.postMessage'
+    if reference is not None and destination.get('lifecycle') == 'thread':
+        payload['thread_ts'] = reference['ts']
+    elif reference is not None:
+        method = 'chat.update'
+        payload['channel'], payload['ts'] = reference['channel'], reference['ts']
+    headers = {'Content-type': 'application/json; charset=utf-8', 'Authorization': f"Bearer {webhook_secrets.resolve_token(destination['token'])}"}
+    return 'POST', f'{SLACK_API_URL}/{method}', request_body(payload), headers
+
+# Status of a lifecycle request, saving the reference of a newly posted message, or dropping it once the incident is
+# resolved. Slack API errors answer 200 with `ok` false, they are reported as 404 when the message is gone and 400
+# otherwise
+def lifecycle_status(messenger, status, data, reference_key, reference, resolved):
+    log.debug('Response: %s, message: %s', status, data)
+    if status != 200:
+        return status
+    try:
+        response = json.loads(data)
+    except ValueError:
+        response = None
+    # Proxies and some webhooks answer without a JSON object, the message was delivered but can not be updated
+    if not isinstance(response, dict):
+        log.warning('No message reference in the response of {}: `{}`'.format(messenger, data[:100]))
+        return status
+    if messenger == 'slack' and not response.get('ok'):
+        log.error('Slack API error: `{}`'.format(response.get('error')))
+        return 404 if response.get('error') in SLACK_MISSING_MESSAGE_ERRORS else 400
+    if resolved:
+        if reference is not None:
+            get_lifecycle_store().delete(reference_key)
+    elif reference is None:
+        if messenger == 'slack':
+            get_lifecycle_store().put(reference_key, {'channel': response['channel'], 'ts': response['ts']})
+        else:
+            get_lifecycle_store().put(reference_key, {'id': response['id']})
+    return status
+
+# Post or update the message of a lifecycle, a message deleted from the channel is posted again
+def post_lifecycle(messenger, webhook_url, message, reference_key, destination, resolved, deadline=None):
+    reference = get_lifecycle_store().get(reference_key)
+    status, data = HTTP_CLIENT.request(*lifecycle_request(messenger, webhook_url, message, destination, reference), deadline=deadline)
+    status = lifecycle_status(messenger, status, data, reference_key, reference, resolved)
+    if status == 404 and reference is not None:
+        get_lifecycle_store().delete(reference_key)
+        return post_lifecycle(messenger, webhook_url, message, reference_key, destination, resolved, deadline)
+    return status
+
+# Coroutine of post_lifecycle, for the async delivery path
+async def post_lifecycle_async(messenger, webhook_url, message, reference_key, destination, resolved, deadline=None):
+    reference = get_lifecycle_store().get(reference_key)
+    status, data = await async_client.request(*lifecycle_request(messenger, webhook_url, message, destination, reference), deadline=deadline)
+    status = lifecycle_status(messenger, status, data, reference_key, reference, resolved)
+    if status == 404 and reference is not None:
+        get_lifecycle_store().delete(reference_key)
+        return await post_lifecycle_async(messenger, webhook_url, message, reference_key, destination, resolved, deadline)
+    return status
+
+# ---------------------------------------------------------------------------------------------------------------------
+# RULES
+# ---------------------------------------------------------------------------------------------------------------------
+# RULES match parsed events by `source`, `detail_type`, `state`, `account` and `region`, each one a value or a list
+# of values, and by `alarm_name`, a regex. The first matching rule drops the event (`drop`), routes it to some
+# destinations by name or messenger (`destinations`) or changes its priority (`priority`), before it is rendered.
+
+RULE_FIELDS = ('source', 'detail_type', 'state', 'account', 'region', 'alarm_name')
+RULE_ACTIONS = ('drop', 'destinations', 'priority')
+
+# Fields of a notification matched by rules
+def event_fields(notification):
+    return {
+        'source': notification.source,
+        'detail_type': notification.detail_type,
+        'state': notification.state,
+        'account': notification.account,
+        'region': notification.region,
+        'alarm_name': notification.resource if notification.source == 'aws.cloudwatch' else None,
+    }
+
+class Rule:
+    __slots__ = ('conditions', 'drop', 'destinations', 'priority')
+
+    def __init__(self, rule: dict):
+        unknown = set(rule) - set(RULE_FIELDS) - set(RULE_ACTIONS)
+        if unknown:
+            raise ValueError(f'Not support rule keys {sorted(unknown)}')
+        self.conditions = list()
+        for field in RULE_FIELDS:
+            if field not in rule:
+                continue
+            if field == 'alarm_name':
+                pattern = re.compile(rule[field])
+                self.conditions.append((field, lambda value: value is not None and pattern.search(value) is not None))
+            else:
+                values = frozenset(rule[field] if isinstance(rule[field], list) else [rule[field]])
+                self.conditions.append((field, values.__contains__))
+        self.drop = bool(rule.get('drop'))
+        self.destinations = rule.get('destinations')
+        self.priority = rule.get('priority')
+
+    def matches(self, fields):
+        return all(predicate(fields[field]) for field, predicate in self.conditions)
+
+# Rules indexed by source, so an event is only checked against the rules of its source and the rules without source
+class RuleMatcher:
+    def __init__(self, rules):
+        self.generic = list()
+        self.index = dict()
+        for rule in rules:
+            compiled = Rule(rule)
+            sources = rule.get('source')
+            if sources is None:
+                self.generic.append(compiled)
+                for source_rules in self.index.values():
+                    source_rules.append(compiled)
+                continue
+            # A source seen for the first time starts with the rules without source defined before it
+            for source in sources if isinstance(sources, list) else [sources]:
+                self.index.setdefault(source, list(self.generic)).append(compiled)
+
+    def match(self, notification):
+        if not isinstance(notification, Notification):
+            return None
+        fields = event_fields(notification)
+        for rule in self.index.get(fields['source'], self.generic):
+            if rule.matches(fields):
+                return rule
+        return None
+
+RULE_MATCHER = RuleMatcher(RULES) if RULES else None
+
+def match_rule(notification):
+    return RULE_MATCHER.match(notification) if RULE_MATCHER is not None else None
+
+# Notification of a message with its matching rule applied, for messages kept by the coalescing buffers
+def ruled_notification(message):
+    notification = notify(message)
+    rule = match_rule(notification)
+    return notification if rule is None else notify(message, rule)
+
+# ---------------------------------------------------------------------------------------------------------------------
+# ROUTING
+# ---------------------------------------------------------------------------------------------------------------------
+# In aggregation mode (ROUTES or ROUTES_URI set) one function receives the events of many accounts and regions and
+# delivers them to the destinations of their (account, region, source) route, see routing.py. Events without route
+# go to DESTINATIONS, the WEBHOOK_URL and MESSENGER destination by default. Invoke the function with `{"action": "reload_routes"}` to reload the table right away.
+
+MESSENGERS = ('slack', 'discord', 'squadcast', 'msteams')
+
+def validate_destination(destination: dict):
+    if destination.get('messenger') not in MESSENGERS:
+        raise ValueError(f'Not support messenger {destination.get("messenger")}')
+
+ROUTER = routing.Router(named=DESTINATIONS, validate=validate_destination) if routing.enabled() else None
+
+# Events without route would be dropped silently
+if ROUTER is not None and not DESTINATIONS and ROUTER.lookup(routing.WILDCARD, routing.WILDCARD, routing.WILDCARD) is None:
+    raise RuntimeError('The routing table has no catch-all route, set WEBHOOK_URL and MESSENGER or DESTINATIONS!')
+
+# Destinations of the route of the notification, rules still narrow them down by name or messenger
+def notification_destinations(notification):
+    if ROUTER is None or not isinstance(notification, Notification):
+        return DESTINATIONS
+    destinations = ROUTER.lookup(notification.account, notification.region, notification.source)
+    if destinations is None:
+        metrics.put('RouteMisses', 1, source=notification.source)
+        return DESTINATIONS
+    return destinations
+
+# ---------------------------------------------------------------------------------------------------------------------
+# DEDUPLICATION
+# ---------------------------------------------------------------------------------------------------------------------
+# Repeated (source, resource, state) notifications within DEDUP_WINDOW seconds are dropped, which also suppresses
+# alarms flapping between ALARM and OK. The in-process LRU cache is checked first, then the optional DEDUP_STORE.
+
+dedup_cache = stores.TTLCache(DEDUP_CACHE_SIZE, DEDUP_WINDOW)
+dedup_store = None
+
+def dedup_key(notification):
+    if not DEDUP_WINDOW or not isinstance(notification, Notification):
+        return None
+    return 'dedup:' + '|'.join(str(value) for value in (notification.source, notification.detail_type, notification.resource, notification.state))
+
+# Check whether the event was already notified within the window, recording it otherwise. The store records it
+# atomically so concurrent containers do not both notify
+def is_duplicate(key):
+    global dedup_store
+    if dedup_cache.get(key):
+        return True
+    if DEDUP_STORE:
+        if dedup_store is None:
+            dedup_store = stores.create_store(DEDUP_STORE)
+        if not dedup_store.put_if_absent(key, True, ttl=DEDUP_WINDOW):
+            dedup_cache.put(key, True)
+            return True
+    dedup_cache.put(key, True)
+    return False
+
+# Forget an event whose delivery failed, so retries are not dropped as duplicates
+def forget_duplicate(key):
+    dedup_cache.delete(key)
+    if dedup_store is not None:
+        dedup_store.delete(key)
+
+# ---------------------------------------------------------------------------------------------------------------------
+# COALESCING
+# ---------------------------------------------------------------------------------------------------------------------
+# Notifications sharing a key are buffered for COALESCE_WINDOW seconds, or until COALESCE_MAX_COUNT of them,
+# and sent as a single digest message. Buffers have no TTL, however late they are found they are flushed. Those of
+# container-local stores are flushed by every invocation of their container, those of shared stores by the scheduled
+# invocations only, sparing a scan of the table to the others. SQS deletes the records of a batch once handled, so
+# they are only buffered in shared stores, local stores would lose them with their container.
+
+coalesce_store = None
+
+def get_coalesce_store():
+    global coalesce_store
+    if coalesce_store is None:
+        coalesce_store = stores.create_store(COALESCE_STORE)
+    return coalesce_store
+
+def coalesce_key(notification):
+    if not COALESCE_WINDOW or not isinstance(notification, Notification) or notification.source not in COALESCE_SOURCES:
+        return None
+    return notification.group
+
+# Buffer message, returns the buffered items when the key reached COALESCE_MAX_COUNT
+def coalesce(key, message):
+    store = get_coalesce_store()
+    bucket = f'coalesce:{key}'
+    count = store.append(bucket, {'at': time.time(), 'message': message})
+    if count >= COALESCE_MAX_COUNT:
+        return store.pop(bucket) or []
+    return None
+
+# Pop the buffers whose window has elapsed
+def due_coalesced(scheduled):
+    due = dict()
+    if not COALESCE_WINDOW:
+        return due
+    store = get_coalesce_store()
+    if store.shared and not scheduled:
+        return due
+    now = time.time()
+    for bucket in store.keys('coalesce:'):
+        items = store.get(bucket)
+        if items and items[0]['at'] + COALESCE_WINDOW <= now:
+            items = store.pop(bucket)
+            if items:
+                due[bucket[len('coalesce:'):]] = items
+    return due
+
+# Merge rendered payloads of the same messenger into a single digest message
+def digest(messenger, title, payloads):
+    if messenger == 'slack':
+        blocks = [{'type': 'header', 'text': {'type': 'plain_text', 'text': title[:150]}}]
+        attachments = list()
+        for payload in payloads:
+            blocks.extend(payload.get('blocks', []))
+            attachments.extend(payload.get('attachments', []))
+        message = {'text': title, 'blocks': blocks}
+        if attachments:
+            message['attachments'] = attachments
+        return message
+
+    elif messenger == 'discord':
+        embeds = [embed for payload in payloads for embed in payload.get('embeds', [])]
+        return {'content': title, 'embeds': embeds}
+
+    elif messenger == 'squadcast':
+        message = dict(payloads[-1])
+        message['message'] = title
+        message['description'] = '\n\n'.join(f"**{payload['message']}**\n{payload['description']}" for payload in payloads)
+        message['event_id'] = title
+        return message
+
+    elif messenger == 'msteams':
+        message = json.loads(json.dumps(payloads[0]))
+        content = message['attachments'][0]['content']
+        content['body'] = [{'type': 'TextBlock', 'size': 'Large', 'weight': 'Bolder', 'text': title, 'wrap': True}]
+        for payload in payloads:
+            content['body'].extend(payload['attachments'][0]['content']['body'])
+        return message
+
+# Characters of the text of a Discord embed, the 6000 characters limit applies to all the embeds of a message
+def embed_length(embed):
+    texts = [embed.get('title'), embed.get('description'), embed.get('footer', {}).get('text'), embed.get('author', {}).get('name')]
+    texts.extend(text for field in embed.get('fields', []) for text in (field.get('name'), field.get('value')))
+    return sum(len(text) for text in texts if isinstance(text, str))
+
+# Whether a digest fits in the messenger limits, digests are not rendered by Templates
+def digest_fits(messenger, message):
+    limit = MESSAGE_LIMITS.get(messenger)
+    if messenger == 'discord':
+        return len(message['embeds']) <= DISCORD_MAX_EMBEDS and sum(map(embed_length, message['embeds'])) <= limit
+    if messenger == 'slack' and len(message['blocks']) > SLACK_MAX_BLOCKS:
+        return False
+    return not limit or len(encoder.encode(message).encode('utf-8')) <= limit
+
+# Render a digest of buffered messages. Digests over the messenger limits leave out the oldest messages
+def render_digest(messenger, key, notifications):
+    if len(notifications) == 1:
+        return render_notification(messenger, notifications[0])
+    payloads = list()
+    for payload in (render_notification(messenger, notification) for notification in notifications):
+        payloads.extend(json.loads(part) for part in (payload if isinstance(payload, list) else [payload]) if isinstance(part, bytes))
+    if not payloads:
+        return None
+    message = digest(messenger, f'{len(notifications)} notifications: {key}', payloads)
+    shown = len(payloads)
+    while shown > 1 and not digest_fits(messenger, message):
+        shown -= 1
+        message = digest(messenger, f'{len(notifications)} notifications, older ones left out: {key}', payloads[-shown:])
+    return message
+
+# Delivery jobs for a digest of buffered items, the buffers keep the messages and their rules are matched again
+def digest_jobs(key, items):
+    notifications = [ruled_notification(item['message']) for item in items]
+    return destination_jobs(notifications[-1], lambda messenger: render_digest(messenger, key, notifications))
+
+# ---------------------------------------------------------------------------------------------------------------------
+# RETRY OUTBOX
+# ---------------------------------------------------------------------------------------------------------------------
+# Deliveries failing after the HTTP retries are persisted, already rendered, to the OUTBOX_STORE and retried by later
+# invocations with exponential backoff. After OUTBOX_MAX_ATTEMPTS they become dead letters, re-driven in bulk by
+# invoking the function with `{"action": "replay"}`. SQS records without outbox keep relying on batchItemFailures.
+
+retry_outbox = None
+
+def get_outbox():
+    global retry_outbox
+    if retry_outbox is None:
+        retry_outbox = outbox.create_outbox(OUTBOX_STORE)
+    return retry_outbox
+
+def retry_delay(attempts):
+    return min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1))
+
+# Delivery job of an outbox entry
+def outbox_job(entry):
+    return (entry['messenger'], entry['webhook_url'], entry['payload'].encode('utf-8'), {'source': entry.get('source')})
+
+# Persist a failed delivery job for a later retry, returns the new record status or None when it could not be saved
+def schedule_retry(job, entry, error):
+    messenger, webhook_url, payload, meta = job
+    if entry is None:
+        entry = {
+            'id': uuid.uuid4().hex,
+            'messenger': messenger,
+            'webhook_url': webhook_url,
+            'payload': payload.decode('utf-8') if isinstance(payload, bytes) else encoder.encode(payload),
+            'source': (meta or {}).get('source'),
+            'attempts': 0,
+        }
+    entry = {**entry, 'attempts': entry['attempts'] + 1, 'error': str(error)}
+    try:
+        if entry['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+            get_outbox().dead(entry)
+            log.error('Delivery `{}` to {} failed {} times, moved to dead letters: {}'.format(entry['id'], messenger, entry['attempts'], error))
+            return 'dead_letter'
+        delay = retry_delay(entry['attempts'])
+        get_outbox().add(entry, delay)
+        log.warning('Delivery `{}` to {} failed, retrying in {:.0f}s (attempt {}): {}'.format(entry['id'], messenger, delay, entry['attempts'], error))
+        return 'queued'
+    except Exception:
+        log.exception('Error saving failed delivery `{}` to the outbox'.format(entry['id']))
+        return None
 
 # Lambda handler
 def lambda_handler(event, context):
-    if LOG_EVENTS:
-        log.info('Event logging enabled: `{}`'.format(json.dumps(event)))
-    if MESSENGER in ('slack', 'discord', 'squadcast', 'msteams'):
-        message = handle_event(MESSENGER, event)
-        response = post(WEBHOOK_URL, message)
-        if response not in (200,204):
-            log.error(
-                "Error: received status `{}` using event `{}` and context `{}`".format(response, json.dumps(event, indent=4), context))
-        return json.dumps({"code": response})
+    global cold_start
+    log_context['request_id'] = getattr(context, 'aws_request_id', None)
+    if cold_start:
+        cold_start = False
+        log.info('Cold start, module imported in %sms', IMPORT_MS, extra={'import_ms': IMPORT_MS})
+    if LOG_EVENTS and random.random() < LOG_EVENTS_SAMPLE_RATE:
+        log.info('Event logging enabled: `%s`', Lazy(lambda: truncated_json(event)))
+    for destination in DESTINATIONS:
+        validate_destination(destination)
 
-    else:
-        raise ValueError(f'Not support messenger {MESSENGER}')
+    replayed = None
+    if OUTBOX_STORE and event.get('action') == 'replay':
+        replayed = get_outbox().replay(event.get('limit'))
+        log.info('Replaying {} dead letters'.format(replayed))
+
+    reloaded = None
+    if ROUTER is not None and event.get('action') == 'reload_routes':
+        try:
+            reloaded = ROUTER.reload() if ROUTER.uri else False
+        except Exception:
+            log.exception('Error reloading the routing table from `{}`'.format(ROUTER.uri))
+            reloaded = False
+
+    inputs = [input_event(item) for item in input_items(event)]
+    scheduled = is_eventbridge_event(event) and event['detail-type'] == SCHEDULED_EVENT
+    results = list()
+    jobs = list()
+    owners = list()
+    entries = list()
+    dedup_keys = dict()
+    for index, received in enumerate(inputs):
+        results.append({'id': received.id, 'code': None, 'status': 'skipped'})
+        try:
+            started = time.perf_counter()
+            message = parse_input(received)
+            # SQS would delete a record reported skipped, unreadable bodies fail and stay in the queue
+            if message is None and received.origin == 'sqs':
+                raise ValueError(f'Not support SQS message body of record `{received.id}`')
+            if OUTBOX_STORE and isinstance(message, dict) and 'outbox' in message:
+                jobs.append(outbox_job(message['outbox']))
+                owners.append(index)
+                entries.append(message['outbox'])
+                continue
+            notification = notify(message)
+            source = notification_source(notification)
+            metrics.put('ParseTime', round((time.perf_counter() - started) * 1000, 3), source=source)
+            rule = match_rule(notification)
+            if rule is not None:
+                if rule.drop:
+                    log.info('Dropping notification `{}` matching a rule'.format(results[index]['id']))
+                    results[index]['status'] = 'dropped'
+                    metrics.put('RuleDrops', 1, source=source)
+                    continue
+                # The priority shows in the rendered text, the message is parsed again with it
+                notification = notify(message, rule)
+            dedup_keys[index] = dedup_key(notification)
+            if dedup_keys[index] is not None and is_duplicate(dedup_keys[index]):
+                log.info('Dropping duplicate notification `{}`'.format(dedup_keys[index]))
+                metrics.put('DedupHits', 1, source=source)
+                results[index]['status'] = 'duplicate'
+                dedup_keys[index] = None
+                continue
+            key = coalesce_key(notification)
+            if key is not None and received.origin == 'sqs' and not get_coalesce_store().shared:
+                key = None
+            if key is None:
+                record_jobs = destination_jobs(notification, lambda messenger: render_notification(messenger, notification))
+            else:
+                results[index]['status'] = 'coalesced'
+                metrics.put('CoalesceHits', 1, source=source)
+                items = coalesce(key, message)
+                record_jobs = digest_jobs(key, items) if items else []
+            jobs.extend(record_jobs)
+            owners.extend([index] * len(record_jobs))
+            entries.extend([None] * len(record_jobs))
+        except Exception:
+            log.exception('Error handling record `{}`'.format(results[index]['id']))
+            results[index]['status'] = 'failed'
+
+    # Digests whose window has elapsed are not owned by any record of this invocation
+    try:
+        for key, items in due_coalesced(scheduled).items():
+            key_jobs = digest_jobs(key, items)
+            jobs.extend(key_jobs)
+            owners.extend([None] * len(key_jobs))
+            entries.extend([None] * len(key_jobs))
+    except Exception:
+        log.exception('Error flushing coalesced notifications')
+
+    # Retries whose backoff has elapsed, SQS outboxes deliver them as records instead. Shared stores are only read
+    # by scheduled invocations
+    if OUTBOX_STORE and (scheduled or not get_outbox().shared):
+        try:
+            for entry in get_outbox().due():
+                jobs.append(outbox_job(entry))
+                owners.append(None)
+                entries.append(entry)
+        except Exception:
+            log.exception('Error reading the outbox')
+
+    for job, index, entry, response in zip(jobs, owners, entries, deliver(jobs, delivery_deadline(context))):
+        failed = isinstance(response, Exception) or response not in (200, 204)
+        retry_status = None
+        # Failed SQS records are redelivered by SQS, unless they were outbox retries already
+        if failed and OUTBOX_STORE and (index is None or entry is not None or inputs[index].origin != 'sqs'):
+            retry_status = schedule_retry(job, entry, response)
+        if index is None:
+            if failed and retry_status is None:
+                log.error('Error delivering digest: `{}`'.format(response))
+            continue
+        result = results[index]
+        if isinstance(response, Exception):
+            if retry_status is None:
+                log.error('Error delivering record `{}`: {}'.format(result['id'], response))
+            if result['status'] != 'failed':
+                result['status'] = retry_status or 'failed'
+            continue
+        if failed:
+            if result['status'] != 'failed':
+                result['status'] = retry_status or 'failed'
+        elif result['status'] not in ('failed', 'queued', 'dead_letter'):
+            result['status'] = 'delivered'
+        if result['code'] in (None, 200, 204):
+            result['code'] = response
+
+    batch_item_failures = list()
+    for index, (received, result) in enumerate(zip(inputs, results)):
+        if result['status'] == 'failed':
+            if dedup_keys.get(index) is not None:
+                forget_duplicate(dedup_keys[index])
+            log.error("Error: received status `%s` using record `%s` and context `%s`",
+                      result['code'], Lazy(lambda: truncated_json(received.record)), context, extra={'record_id': result['id']})
+            if received.origin == 'sqs':
+                batch_item_failures.append({'itemIdentifier': result['id']})
+
+    log.debug('Memoization caches: %s', Lazy(memo_stats))
+    metrics.flush()
+
+    # SQS event source mappings with ReportBatchItemFailures only redeliver the failed messages
+    if any(received.origin == 'sqs' for received in inputs):
+        return {'batchItemFailures': batch_item_failures}
+
+    codes = [result['code'] for result in results if result['code'] is not None]
+    failed = [result['code'] for result in results if result['status'] == 'failed']
+    code = failed[0] if failed else (codes[-1] if codes else None)
+    response = {"code": code, "results": results}
+    if replayed is not None:
+        response["replayed"] = replayed
+    if reloaded is not None:
+        response["routes_reloaded"] = reloaded
+    return json.dumps(response)
+
+# Import duration of the module, in milliseconds
+IMPORT_MS = round((time.perf_counter() - IMPORT_STARTED) * 1000, 3)
+cold_start = True
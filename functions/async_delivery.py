@@ -0,0 +1,189 @@
+import ssl
+import atexit
+import time
+import asyncio
+import logging
+import urllib.parse
+import metrics
+
+# ---------------------------------------------------------------------------------------------------------------------
+# ASYNC DELIVERY
+# ---------------------------------------------------------------------------------------------------------------------
+# asyncio delivery path, used when DELIVERY_MODE is async. Imported on first use only, asyncio is slow to import.
+# The event loop lives as long as the container, so keep-alive connections are reused by warm invocations.
+
+log = logging.getLogger()
+
+loop = asyncio.new_event_loop()
+
+# Final responses without body whatever their headers, RFC 7230 section 3.3.3
+BODILESS_STATUS_CODES = (204, 304)
+
+# Methods whose request is not sent again once fully written, the server may have processed it
+NON_IDEMPOTENT_METHODS = ('POST', 'PATCH')
+
+# No response in time to a request fully written
+class ResponseTimeout(Exception):
+    pass
+
+class AsyncHTTPClient:
+    def __init__(self, connect_timeout, read_timeout, total_timeout, max_retries, backoff, retry_status_codes):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.total_timeout = total_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.retry_status_codes = retry_status_codes
+        self._pool = {}
+        self._ssl = None
+        atexit.register(self.close)
+
+    # Close the idle connections before the interpreter exits, asyncio can not close them once torn down
+    def close(self):
+        for connections in self._pool.values():
+            for reader, writer in connections:
+                writer.close()
+        self._pool.clear()
+        if not loop.is_closed():
+            loop.run_until_complete(asyncio.sleep(0))
+
+    # Timeout of an attempt, cut to the time left before the deadline of the request
+    def _timeout(self, timeout, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise asyncio.TimeoutError(f'No time left of the {self.total_timeout}s total timeout')
+        return min(timeout, remaining)
+
+    async def _acquire(self, scheme, host, port, deadline):
+        connect_timeout = self._timeout(self.connect_timeout, deadline)
+        idle = self._pool.get((scheme, host, port))
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        if scheme == 'https' and self._ssl is None:
+            self._ssl = ssl.create_default_context()
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=self._ssl if scheme == 'https' else None),
+            connect_timeout,
+        )
+        return reader, writer, False
+
+    def _release(self, scheme, host, port, connection):
+        self._pool.setdefault((scheme, host, port), []).append(connection)
+
+    async def _read_head(self, reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError('Connection closed by the server')
+        version, status = status_line.decode('latin-1').split(None, 2)[:2]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().title()] = value.strip()
+        return version, int(status), headers
+
+    async def _read_response(self, reader):
+        version, status, headers = await self._read_head(reader)
+        # Interim responses (1xx) come before the final one
+        while 100 <= status < 200:
+            version, status, headers = await self._read_head(reader)
+        if status in BODILESS_STATUS_CODES:
+            data = b''
+        elif headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            data = b''.join(chunks)
+        elif 'Content-Length' in headers:
+            data = await reader.readexactly(int(headers['Content-Length']))
+        else:
+            data = await reader.read()
+            headers['Connection'] = 'close'
+        will_close = version == 'HTTP/1.0' or headers.get('Connection', '').lower() == 'close'
+        return status, headers, data, will_close
+
+    async def _exchange(self, connection, method, host, path, body, headers, deadline):
+        reader, writer = connection
+        lines = [f'{method} {path} HTTP/1.1', f'Host: {host}', f'Content-Length: {len(body or b"")}']
+        lines.extend(f'{name}: {value}' for name, value in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (body or b''))
+        try:
+            await writer.drain()
+            return await asyncio.wait_for(self._read_response(reader), self._timeout(self.read_timeout, deadline))
+        except asyncio.TimeoutError:
+            writer.close()
+            if method in NON_IDEMPOTENT_METHODS:
+                # The path of a webhook URL is its secret, only the host is named
+                raise ResponseTimeout(f'No response in time to {method} {host}')
+            raise
+        except BaseException:
+            writer.close()
+            raise
+
+    async def _send(self, method, url, body, headers, deadline):
+        parsed = urllib.parse.urlsplit(url)
+        path = parsed.path or '/'
+        if parsed.query:
+            path = f'{path}?{parsed.query}'
+        scheme, host = parsed.scheme, parsed.hostname
+        port = parsed.port or (443 if scheme == 'https' else 80)
+        reader, writer, reused = await self._acquire(scheme, host, port, deadline)
+        try:
+            status, response_headers, data, will_close = await self._exchange((reader, writer), method, parsed.netloc, path, body, headers, deadline)
+        except (ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError):
+            if not reused:
+                raise
+            # The server closed an idle keep-alive connection, retry once on a fresh one
+            for idle_reader, idle_writer in self._pool.pop((scheme, host, port), []):
+                idle_writer.close()
+            reader, writer, reused = await self._acquire(scheme, host, port, deadline)
+            status, response_headers, data, will_close = await self._exchange((reader, writer), method, parsed.netloc, path, body, headers, deadline)
+        if will_close:
+            writer.close()
+        else:
+            self._release(scheme, host, port, (reader, writer))
+        return status, response_headers, data
+
+    async def request(self, method, url, body=None, headers=None, deadline=None):
+        deadline = min(time.monotonic() + self.total_timeout, deadline or float('inf'))
+        attempt = 0
+        while True:
+            response_headers = None
+            try:
+                status, response_headers, data = await self._send(method, url, body, headers or {}, deadline)
+                if status not in self.retry_status_codes:
+                    return status, data
+                error = None
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as exception:
+                status, data, error = None, None, exception
+            delay = self.backoff(attempt, response_headers)
+            if attempt >= self.max_retries or time.monotonic() + delay >= deadline:
+                if error is not None:
+                    raise error
+                return status, data
+            attempt += 1
+            log.warning('Retrying request in {:.2f}s (attempt {}), status: `{}`, error: `{}`'.format(delay, attempt, status, error))
+            metrics.put('Retries', 1)
+            await asyncio.sleep(delay)
+
+# Run deliver_one coroutines for every job with at most `concurrency` of them in flight, results keep the job order
+def deliver(jobs, deliver_one, concurrency):
+    async def bounded(semaphore, job):
+        async with semaphore:
+            return await deliver_one(*job)
+
+    async def gather():
+        semaphore = asyncio.Semaphore(concurrency)
+        return await asyncio.gather(*(bounded(semaphore, job) for job in jobs))
+
+    return loop.run_until_complete(gather())
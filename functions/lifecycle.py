@@ -0,0 +1,47 @@
+import os
+import stores
+
+# ---------------------------------------------------------------------------------------------------------------------
+# ENVIRONMENT VARIABLES
+# ---------------------------------------------------------------------------------------------------------------------
+
+LIFECYCLE_TTL = int(os.getenv('LIFECYCLE_TTL', '604800'))
+LIFECYCLE_CACHE_SIZE = int(os.getenv('LIFECYCLE_CACHE_SIZE', '1024'))
+
+# ---------------------------------------------------------------------------------------------------------------------
+# LIFECYCLE
+# ---------------------------------------------------------------------------------------------------------------------
+# References of the messages posted for alert lifecycles (an alarm, a pipeline execution, a build) by destination,
+# e.g. the Discord message id or the Slack channel and ts, so later notifications update or reply to that message.
+# Shared stores are read on every notification, another container may have updated or ended the lifecycle since.
+# References of the file store, seen by this container only, are cached in memory.
+
+class LifecycleStore:
+    def __init__(self, store, ttl=LIFECYCLE_TTL, cache_size=LIFECYCLE_CACHE_SIZE):
+        self.store = store
+        self.ttl = ttl
+        # A memory store is the cache already, and a cache would serve stale references of a shared store
+        self.cache = None if store.shared or isinstance(store, stores.MemoryStore) else stores.TTLCache(cache_size, ttl)
+
+    def get(self, key):
+        if self.cache is not None:
+            reference = self.cache.get(key)
+            if reference is not None:
+                return reference
+        reference = self.store.get(f'lifecycle:{key}')
+        if reference is not None and self.cache is not None:
+            self.cache.put(key, reference)
+        return reference
+
+    def put(self, key, reference):
+        self.store.put(f'lifecycle:{key}', reference, ttl=self.ttl)
+        if self.cache is not None:
+            self.cache.put(key, reference)
+
+    def delete(self, key):
+        self.store.delete(f'lifecycle:{key}')
+        if self.cache is not None:
+            self.cache.delete(key)
+
+def create_lifecycle_store(kind):
+    return LifecycleStore(stores.create_store(kind))
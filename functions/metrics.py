@@ -0,0 +1,83 @@
+import os
+import sys
+import json
+import time
+import threading
+import contextvars
+
+# ---------------------------------------------------------------------------------------------------------------------
+# ENVIRONMENT VARIABLES
+# ---------------------------------------------------------------------------------------------------------------------
+
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', '')
+
+# ---------------------------------------------------------------------------------------------------------------------
+# METRICS
+# ---------------------------------------------------------------------------------------------------------------------
+# CloudWatch Embedded Metric Format: metrics are printed as JSON log lines and extracted by CloudWatch Logs, without
+# any API call. Values are collected during the invocation and flushed as one line per set of dimensions.
+
+UNITS = {
+    'ParseTime': 'Milliseconds',
+    'RenderTime': 'Milliseconds',
+    'HttpTime': 'Milliseconds',
+    'PayloadBytes': 'Bytes',
+}
+
+# EMF accepts at most 100 values per metric and line
+MAX_VALUES = 100
+
+# Dimensions of the metrics put by the code running a delivery, e.g. HTTP retries
+dimensions = contextvars.ContextVar('metric_dimensions', default={})
+
+class Metrics:
+    def __init__(self, namespace=METRICS_NAMESPACE, stream=None):
+        self.namespace = namespace
+        self.stream = stream
+        self._values = {}
+        self._lock = threading.Lock()
+
+    # Dimensions default to the ones set in the context of the running delivery
+    def put(self, name, value, **metric_dimensions):
+        if not self.namespace:
+            return
+        labels = metric_dimensions or dimensions.get()
+        key = tuple(sorted((dimension, 'unknown' if label is None else str(label)) for dimension, label in labels.items()))
+        with self._lock:
+            self._values.setdefault(key, {}).setdefault(name, []).append(value)
+
+    def lines(self):
+        with self._lock:
+            values, self._values = self._values, {}
+        timestamp = int(time.time() * 1000)
+        for key, metrics in values.items():
+            for start in range(0, max(map(len, metrics.values())), MAX_VALUES):
+                chunk = {name: samples[start:start + MAX_VALUES] for name, samples in metrics.items() if samples[start:start + MAX_VALUES]}
+                yield {
+                    '_aws': {
+                        'Timestamp': timestamp,
+                        'CloudWatchMetrics': [{
+                            'Namespace': self.namespace,
+                            'Dimensions': [[dimension for dimension, _ in key]],
+                            'Metrics': [{'Name': name, 'Unit': UNITS.get(name, 'Count')} for name in chunk],
+                        }],
+                    },
+                    **dict(key),
+                    **{name: samples if len(samples) > 1 else samples[0] for name, samples in chunk.items()},
+                }
+
+    def flush(self):
+        if not self.namespace:
+            return
+        stream = self.stream or sys.stdout
+        for line in self.lines():
+            stream.write(json.dumps(line, separators=(',', ':')) + '\n')
+        stream.flush()
+
+collector = Metrics()
+
+def put(name, value, **metric_dimensions):
+    collector.put(name, value, **metric_dimensions)
+
+def flush():
+    collector.flush()
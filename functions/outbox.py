@@ -0,0 +1,104 @@
+import os
+import json
+import time
+import stores
+
+# ---------------------------------------------------------------------------------------------------------------------
+# ENVIRONMENT VARIABLES
+# ---------------------------------------------------------------------------------------------------------------------
+
+OUTBOX_TTL = int(os.getenv('OUTBOX_TTL', '604800'))
+OUTBOX_QUEUE_URL = os.getenv('OUTBOX_QUEUE_URL', '')
+OUTBOX_DEAD_LETTER_QUEUE_URL = os.getenv('OUTBOX_DEAD_LETTER_QUEUE_URL', '')
+SQS_ENDPOINT = os.getenv('SQS_ENDPOINT', '')
+
+# ---------------------------------------------------------------------------------------------------------------------
+# OUTBOX
+# ---------------------------------------------------------------------------------------------------------------------
+# Rendered payloads whose delivery failed, waiting for a retry or, after too many attempts, for a replay.
+# Entries are dicts with `id`, `messenger`, `webhook_url`, `payload` (JSON text), `attempts` and `error`.
+
+# Outbox on top of a key/value store, due entries are claimed with `pop` so only one invocation retries them
+class StoreOutbox:
+    def __init__(self, store):
+        self.store = store
+        self.shared = store.shared
+
+    def add(self, entry, delay):
+        self.store.put(f"outbox:{entry['id']}", {**entry, 'due': time.time() + delay}, ttl=OUTBOX_TTL)
+
+    def due(self, limit=None):
+        entries = list()
+        now = time.time()
+        for key in self.store.keys('outbox:'):
+            entry = self.store.get(key)
+            if entry is None or entry['due'] > now:
+                continue
+            entry = self.store.pop(key)
+            if entry is not None:
+                entries.append(entry)
+            if limit and len(entries) >= limit:
+                break
+        return entries
+
+    def dead(self, entry):
+        self.store.put(f"dead:{entry['id']}", entry, ttl=OUTBOX_TTL)
+
+    # Move dead letters back to the outbox with their attempts reset, returns how many were moved
+    def replay(self, limit=None):
+        replayed = 0
+        for key in self.store.keys('dead:'):
+            if limit and replayed >= limit:
+                break
+            entry = self.store.pop(key)
+            if entry is not None:
+                self.add({**entry, 'attempts': 0}, 0)
+                replayed += 1
+        return replayed
+
+# Outbox on SQS, retries are delayed messages delivered back to the function by the queue event source mapping
+# as `{"outbox": entry}` bodies, dead letters are sent to a second queue
+class SQSOutbox:
+    MAX_DELAY = 900
+    shared = True
+
+    def __init__(self, queue_url=OUTBOX_QUEUE_URL, dead_letter_queue_url=OUTBOX_DEAD_LETTER_QUEUE_URL, endpoint_url=SQS_ENDPOINT):
+        import boto3
+        self.queue_url = queue_url
+        self.dead_letter_queue_url = dead_letter_queue_url
+        self.client = boto3.client('sqs', endpoint_url=endpoint_url or None)
+
+    def add(self, entry, delay):
+        self.client.send_message(
+            QueueUrl=self.queue_url,
+            MessageBody=json.dumps({'outbox': entry}),
+            DelaySeconds=min(int(delay), self.MAX_DELAY),
+        )
+
+    def due(self, limit=None):
+        return []
+
+    def dead(self, entry):
+        self.client.send_message(QueueUrl=self.dead_letter_queue_url, MessageBody=json.dumps({'outbox': entry}))
+
+    def replay(self, limit=None):
+        replayed = 0
+        while not limit or replayed < limit:
+            messages = self.client.receive_message(
+                QueueUrl=self.dead_letter_queue_url,
+                MaxNumberOfMessages=min(10, limit - replayed) if limit else 10,
+                WaitTimeSeconds=0,
+            ).get('Messages', [])
+            if not messages:
+                break
+            for message in messages:
+                entry = json.loads(message['Body'])['outbox']
+                self.add({**entry, 'attempts': 0}, 0)
+                self.client.delete_message(QueueUrl=self.dead_letter_queue_url, ReceiptHandle=message['ReceiptHandle'])
+                replayed += 1
+        return replayed
+
+def create_outbox(kind):
+    if kind == 'sqs':
+        return SQSOutbox()
+    return StoreOutbox(stores.create_store(kind))
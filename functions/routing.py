@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import logging
+import threading
+
+# ---------------------------------------------------------------------------------------------------------------------
+# ENVIRONMENT VARIABLES
+# ---------------------------------------------------------------------------------------------------------------------
+
+ROUTES = json.loads(os.getenv('ROUTES') or '[]')
+ROUTES_URI = os.getenv('ROUTES_URI', '')
+ROUTES_RELOAD_INTERVAL = float(os.getenv('ROUTES_RELOAD_INTERVAL', '60'))
+
+# ---------------------------------------------------------------------------------------------------------------------
+# ROUTING
+# ---------------------------------------------------------------------------------------------------------------------
+# Routing table of the aggregation mode, where one function receives the events of many accounts and regions.
+# Routes have an `account`, a `region` and a `source`, each one a value, a list of values or `*` (the default), and
+# `destinations`, destination objects or names of DESTINATIONS. A lookup probes the exact and wildcard combinations
+# of the three fields, so it costs the same whatever the number of accounts. Tables read from ROUTES_URI, a file
+# path or a `s3://bucket/key` URI, are reloaded when they change, checked at most every ROUTES_RELOAD_INTERVAL seconds.
+
+log = logging.getLogger()
+
+WILDCARD = '*'
+ROUTE_FIELDS = ('account', 'region', 'source')
+ROUTE_KEYS = ROUTE_FIELDS + ('destinations',)
+
+# Lookup keys from the most to the least specific one, an account route wins over a region route over a source route
+def lookup_keys(account, region, source):
+    return (
+        (account, region, source),
+        (account, region, WILDCARD),
+        (account, WILDCARD, source),
+        (account, WILDCARD, WILDCARD),
+        (WILDCARD, region, source),
+        (WILDCARD, region, WILDCARD),
+        (WILDCARD, WILDCARD, source),
+        (WILDCARD, WILDCARD, WILDCARD),
+    )
+
+def route_values(route, field):
+    values = route.get(field, WILDCARD)
+    return values if isinstance(values, list) else [values]
+
+# Routes indexed by (account, region, source), routes of the same key add their destinations
+class RoutingTable:
+    def __init__(self, routes, named=None, validate=None):
+        named = {destination['name']: destination for destination in named or [] if destination.get('name')}
+        self.index = dict()
+        for route in routes:
+            unknown = set(route) - set(ROUTE_KEYS)
+            if unknown:
+                raise ValueError(f'Not support route keys {sorted(unknown)}')
+            destinations = list()
+            for destination in route.get('destinations', []):
+                if isinstance(destination, str):
+                    if destination not in named:
+                        raise ValueError(f'Not found destination {destination}')
+                    destination = named[destination]
+                if validate is not None:
+                    validate(destination)
+                destinations.append(destination)
+            for account in route_values(route, 'account'):
+                for region in route_values(route, 'region'):
+                    for source in route_values(route, 'source'):
+                        self.index.setdefault((account, region, source), list()).extend(destinations)
+
+    def __len__(self):
+        return len(self.index)
+
+    # Destinations of the most specific route, None when no route matches. A route without destinations mutes events
+    def lookup(self, account, region, source):
+        for key in lookup_keys(account, region, source):
+            destinations = self.index.get(key)
+            if destinations is not None:
+                return destinations
+        return None
+
+# S3 client, created on first use
+s3_client = None
+
+# Routes of a `s3://bucket/key` URI or a file path with their version (ETag or modification time),
+# None when the version did not change
+def read_routes(uri, version=None):
+    global s3_client
+    if uri.startswith('s3://'):
+        bucket, _, key = uri[len('s3://'):].partition('/')
+        if s3_client is None:
+            import boto3
+            s3_client = boto3.client('s3')
+        try:
+            response = s3_client.get_object(Bucket=bucket, Key=key, **({'IfNoneMatch': version} if version else {}))
+        except Exception as exception:
+            if getattr(exception, 'response', {}).get('Error', {}).get('Code') in ('304', 'NotModified'):
+                return None, version
+            raise
+        return json.loads(response['Body'].read()), response['ETag']
+    modified = os.stat(uri).st_mtime_ns
+    if modified == version:
+        return None, version
+    with open(uri) as file:
+        return json.load(file), modified
+
+# Routing table loaded once by the container, inline ROUTES first then the ones of ROUTES_URI
+class Router:
+    def __init__(self, routes=ROUTES, uri=ROUTES_URI, reload_interval=ROUTES_RELOAD_INTERVAL, named=None, validate=None):
+        self.routes = routes
+        self.uri = uri
+        self.reload_interval = reload_interval
+        self.named = named
+        self.validate = validate
+        self.version = None
+        self.checked = time.monotonic()
+        self._lock = threading.Lock()
+        self.table = RoutingTable(routes, named, validate)
+        if uri:
+            self.reload()
+
+    # Load the table of the URI when it changed, returns whether it did. The current table is kept on errors
+    def reload(self):
+        with self._lock:
+            self.checked = time.monotonic()
+            routes, version = read_routes(self.uri, self.version)
+            if routes is None:
+                return False
+            self.table = RoutingTable(self.routes + routes, self.named, self.validate)
+            self.version = version
+        log.info('Routing table loaded from `{}`, {} routes'.format(self.uri, len(self.table)))
+        return True
+
+    def lookup(self, account, region, source):
+        if self.uri and time.monotonic() - self.checked >= self.reload_interval:
+            try:
+                self.reload()
+            except Exception:
+                log.exception('Error reloading the routing table from `{}`'.format(self.uri))
+        return self.table.lookup(account, region, source)
+
+def enabled():
+    return bool(ROUTES or ROUTES_URI)
@@ -0,0 +1,272 @@
+import os
+import json
+import time
+import fcntl
+import threading
+from collections import OrderedDict
+
+# ---------------------------------------------------------------------------------------------------------------------
+# ENVIRONMENT VARIABLES
+# ---------------------------------------------------------------------------------------------------------------------
+
+STORE_FILE_PATH = os.getenv('STORE_FILE_PATH', '/tmp/lambda-notifications-store.json')
+STORE_DYNAMODB_TABLE = os.getenv('STORE_DYNAMODB_TABLE', '')
+STORE_DYNAMODB_ENDPOINT = os.getenv('STORE_DYNAMODB_ENDPOINT', '')
+
+# ---------------------------------------------------------------------------------------------------------------------
+# STORES
+# ---------------------------------------------------------------------------------------------------------------------
+# Key/value stores keeping state between invocations. Values must be JSON serializable, `ttl` is in seconds.
+# `shared` stores are seen by every container, listing their keys is a request worth sparing.
+
+def expiration(ttl):
+    return time.time() + ttl if ttl else None
+
+def expired(expires_at):
+    return expires_at is not None and expires_at <= time.time()
+
+# Bounded LRU cache with TTL eviction, kept in memory by the warm container
+class TTLCache:
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or expired(entry[1]):
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (value, expiration(ttl or self.ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+# In-memory store, shared by invocations of the same warm container
+class MemoryStore:
+    shared = False
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def _live(self, key):
+        entry = self._data.get(key)
+        if entry is not None and expired(entry[1]):
+            del self._data[key]
+            return None
+        return entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._live(key)
+            return entry[0] if entry else None
+
+    def put(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (value, expiration(ttl))
+
+    # Store value unless a live one exists, returns whether it was stored
+    def put_if_absent(self, key, value, ttl=None):
+        with self._lock:
+            if self._live(key) is not None:
+                return False
+            self._data[key] = (value, expiration(ttl))
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._live(key)
+            self._data.pop(key, None)
+            return entry[0] if entry else None
+
+    # Append item to the list stored at key, the TTL is set when the list is created
+    def append(self, key, item, ttl=None):
+        with self._lock:
+            entry = self._live(key)
+            if entry is None:
+                entry = ([], expiration(ttl))
+                self._data[key] = entry
+            entry[0].append(item)
+            return len(entry[0])
+
+    def keys(self, prefix=''):
+        with self._lock:
+            return [key for key in list(self._data) if key.startswith(prefix) and self._live(key)]
+
+# File-backed store, a JSON document locked with flock. Used for offline testing or to share /tmp state
+class FileStore:
+    shared = False
+
+    def __init__(self, path=STORE_FILE_PATH):
+        self.path = path
+
+    def _update(self, func):
+        with open(self.path, 'a+') as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                file.seek(0)
+                content = file.read()
+                data = json.loads(content) if content else {}
+                data = {key: entry for key, entry in data.items() if not expired(entry[1])}
+                result = func(data)
+                file.seek(0)
+                file.truncate()
+                json.dump(data, file)
+                file.flush()
+                return result
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+    def get(self, key):
+        entry = self._update(lambda data: data.get(key))
+        return entry[0] if entry else None
+
+    def put(self, key, value, ttl=None):
+        self._update(lambda data: data.__setitem__(key, [value, expiration(ttl)]))
+
+    def put_if_absent(self, key, value, ttl=None):
+        def put_absent(data):
+            if key in data:
+                return False
+            data[key] = [value, expiration(ttl)]
+            return True
+        return self._update(put_absent)
+
+    def delete(self, key):
+        self._update(lambda data: data.pop(key, None))
+
+    def pop(self, key):
+        entry = self._update(lambda data: data.pop(key, None))
+        return entry[0] if entry else None
+
+    def append(self, key, item, ttl=None):
+        def append_item(data):
+            entry = data.setdefault(key, [[], expiration(ttl)])
+            entry[0].append(item)
+            return len(entry[0])
+        return self._update(append_item)
+
+    def keys(self, prefix=''):
+        return self._update(lambda data: [key for key in data if key.startswith(prefix)])
+
+# DynamoDB store, table with a `key` string partition key and `expires_at` as TTL attribute.
+# STORE_DYNAMODB_ENDPOINT points it to DynamoDB Local for offline testing
+class DynamoDBStore:
+    shared = True
+
+    def __init__(self, table=STORE_DYNAMODB_TABLE, endpoint_url=STORE_DYNAMODB_ENDPOINT):
+        import boto3
+        self.table = table
+        self.client = boto3.client('dynamodb', endpoint_url=endpoint_url or None)
+
+    def _key(self, key):
+        return {'key': {'S': key}}
+
+    def _value(self, item):
+        if not item or expired(float(item['expires_at']['N']) if 'expires_at' in item else None):
+            return None
+        if 'items' in item:
+            return [json.loads(value['S']) for value in item['items']['L']]
+        return json.loads(item['value']['S'])
+
+    def get(self, key):
+        response = self.client.get_item(TableName=self.table, Key=self._key(key), ConsistentRead=True)
+        return self._value(response.get('Item'))
+
+    def put(self, key, value, ttl=None):
+        item = {**self._key(key), 'value': {'S': json.dumps(value)}}
+        if ttl:
+            item['expires_at'] = {'N': str(int(expiration(ttl)))}
+        self.client.put_item(TableName=self.table, Item=item)
+
+    # Conditional put, items past their TTL may linger until DynamoDB deletes them and count as absent
+    def put_if_absent(self, key, value, ttl=None):
+        item = {**self._key(key), 'value': {'S': json.dumps(value)}}
+        if ttl:
+            item['expires_at'] = {'N': str(int(expiration(ttl)))}
+        try:
+            self.client.put_item(
+                TableName=self.table,
+                Item=item,
+                ConditionExpression='attribute_not_exists(#key) OR expires_at <= :now',
+                ExpressionAttributeNames={'#key': 'key'},
+                ExpressionAttributeValues={':now': {'N': str(int(time.time()))}},
+            )
+        except Exception as exception:
+            if getattr(exception, 'response', {}).get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+    def delete(self, key):
+        self.client.delete_item(TableName=self.table, Key=self._key(key))
+
+    def pop(self, key):
+        response = self.client.delete_item(TableName=self.table, Key=self._key(key), ReturnValues='ALL_OLD')
+        return self._value(response.get('Attributes'))
+
+    def append(self, key, item, ttl=None):
+        expression = 'SET #items = list_append(if_not_exists(#items, :empty), :item)'
+        values = {':empty': {'L': []}, ':item': {'L': [{'S': json.dumps(item)}]}}
+        if ttl:
+            expression += ', expires_at = if_not_exists(expires_at, :expires_at)'
+            values[':expires_at'] = {'N': str(int(expiration(ttl)))}
+        response = self.client.update_item(
+            TableName=self.table,
+            Key=self._key(key),
+            UpdateExpression=expression,
+            ExpressionAttributeNames={'#items': 'items'},
+            ExpressionAttributeValues=values,
+            ReturnValues='UPDATED_NEW',
+        )
+        return len(response['Attributes']['items']['L'])
+
+    def keys(self, prefix=''):
+        keys = list()
+        paginator = self.client.get_paginator('scan')
+        for page in paginator.paginate(
+            TableName=self.table,
+            ProjectionExpression='#key, expires_at',
+            FilterExpression='begins_with(#key, :prefix)',
+            ExpressionAttributeNames={'#key': 'key'},
+            ExpressionAttributeValues={':prefix': {'S': prefix}},
+        ):
+            for item in page['Items']:
+                if not expired(float(item['expires_at']['N']) if 'expires_at' in item else None):
+                    keys.append(item['key']['S'])
+        return keys
+
+STORES = {
+    'memory': MemoryStore,
+    'file': FileStore,
+    'dynamodb': DynamoDBStore,
+}
+
+def create_store(kind):
+    if kind not in STORES:
+        raise ValueError(f'Not support store {kind}')
+    return STORES[kind]()
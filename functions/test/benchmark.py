@@ -0,0 +1,249 @@
+import os
+import sys
+import json
+import glob
+import time
+import argparse
+import statistics
+import subprocess
+import threading
+import tracemalloc
+import http.server
+
+# Offline benchmark replaying the events of this directory through handle_event and lambda_handler.
+# Webhooks are replaced by a local HTTP stub server, so no network access or AWS credentials are needed.
+#
+#   python3 test/benchmark.py --iterations 200 --batch-size 50
+#   python3 test/benchmark.py --output baseline.json
+#   python3 test/benchmark.py --baseline baseline.json --max-regression 0.2
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+FUNCTIONS_DIR = os.path.dirname(TEST_DIR)
+MESSENGERS = ('slack', 'discord', 'squadcast', 'msteams')
+
+# ---------------------------------------------------------------------------------------------------------------------
+# WEBHOOK STUB
+# ---------------------------------------------------------------------------------------------------------------------
+
+class WebhookStub(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, Nagle would delay every response by the client delayed ACK
+    disable_nagle_algorithm = True
+    status = 200
+    delay = 0.0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.delay:
+            time.sleep(self.delay)
+        self.send_response(self.status)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stub(delay=0.0):
+    WebhookStub.delay = delay
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), WebhookStub)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}/webhook'
+
+# ---------------------------------------------------------------------------------------------------------------------
+# FIXTURES
+# ---------------------------------------------------------------------------------------------------------------------
+
+# SNS record wrapping a raw EventBridge or CloudWatch message
+def sns_record(message, message_id):
+    return {
+        'EventSource': 'aws:sns',
+        'EventVersion': '1.0',
+        'Sns': {
+            'Type': 'Notification',
+            'MessageId': message_id,
+            'Message': json.dumps(message),
+        },
+    }
+
+# Records of every fixture. Files holding several raw events separated by `# comment` lines are split
+def load_records():
+    records = dict()
+    for path in sorted(glob.glob(os.path.join(TEST_DIR, '*.json'))):
+        name = os.path.basename(path)[:-len('.json')]
+        with open(path) as file:
+            content = file.read()
+        try:
+            records[name] = json.loads(content)['Records']
+            continue
+        except ValueError:
+            pass
+        chunks = [chunk for chunk in content.split('\n#') if chunk.strip()]
+        for index, chunk in enumerate(chunks):
+            body = chunk[chunk.index('{'):]
+            records[f'{name}-{index}'] = [sns_record(json.loads(body), f'{name}-{index}')]
+    return records
+
+# Synthetic batch cycling through every fixture
+def synthetic_batch(records, size):
+    pool = [record for fixture in records.values() for record in fixture]
+    return {'Records': [pool[index % len(pool)] for index in range(size)]}
+
+# ---------------------------------------------------------------------------------------------------------------------
+# MEASUREMENTS
+# ---------------------------------------------------------------------------------------------------------------------
+
+def percentiles(samples):
+    samples = sorted(samples)
+    quantiles = statistics.quantiles(samples, n=100, method='inclusive') if len(samples) > 1 else samples * 99
+    return {
+        'p50': round(quantiles[49] * 1000, 4),
+        'p90': round(quantiles[89] * 1000, 4),
+        'p99': round(quantiles[98] * 1000, 4),
+        'max': round(samples[-1] * 1000, 4),
+    }
+
+def timed(func, iterations):
+    samples = list()
+    for _ in range(iterations):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return percentiles(samples)
+
+# Transient memory peak and retained bytes per call
+def allocations(func, iterations):
+    tracemalloc.start()
+    func()
+    peaks = list()
+    retained, _ = tracemalloc.get_traced_memory()
+    start = retained
+    for _ in range(iterations):
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        func()
+        after, peak = tracemalloc.get_traced_memory()
+        peaks.append(peak - before)
+        retained = after
+    tracemalloc.stop()
+    return {
+        'peak_bytes': round(statistics.median(peaks), 2),
+        'retained_bytes': round((retained - start) / iterations, 2),
+    }
+
+# Fresh interpreter importing app then handling one event, as a cold Lambda container does
+COLD_SCRIPT = """
+import sys, json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.lambda_handler(json.loads(sys.argv[1]), None)
+print(json.dumps([imported - started, time.perf_counter() - started, app.IMPORT_MS / 1000]))
+"""
+
+# Wall times of cold imports and cold notifications, and the import time reported by the module
+def cold_import(url, runs, event):
+    env = dict(os.environ, WEBHOOK_URL=url, MESSENGER='slack', LOG_LEVEL='CRITICAL')
+    samples = {'import': [], 'notification': [], 'reported_import': []}
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', COLD_SCRIPT, json.dumps(event)], cwd=FUNCTIONS_DIR, env=env, capture_output=True, text=True, check=True)
+        for key, value in zip(samples, json.loads(output.stdout.strip().splitlines()[-1])):
+            samples[key].append(value)
+    return {key: percentiles(values) for key, values in samples.items()}
+
+def benchmark(app, records, url, iterations, batch_size):
+    report = {'stages': {}, 'handle_event': {}, 'lambda_handler': {}, 'allocations': {}}
+    stages = report['stages']
+    for name, fixture in records.items():
+        record = fixture[0]
+        message = app.parse_record(record)
+        stages[name] = {
+            'parse': timed(lambda: app.parse_record(record), iterations),
+            'classify': timed(lambda: app.classify(message), iterations),
+        }
+        for messenger in MESSENGERS:
+            try:
+                payload = app.render(messenger, message)
+            except Exception as exception:
+                stages[name][f'render_{messenger}'] = {'error': repr(exception)}
+                payload = None
+                continue
+            stages[name][f'render_{messenger}'] = timed(lambda: app.render(messenger, message), iterations)
+            if isinstance(payload, dict):
+                stages[name][f'serialize_{messenger}'] = timed(lambda: app.encoder.encode(payload).encode('utf-8'), iterations)
+            report['allocations'][f'{name}_{messenger}'] = allocations(lambda: app.render(messenger, message), iterations)
+        if isinstance(payload, (bytes, dict)):
+            stages[name]['delivery'] = timed(lambda: app.post(url, payload), iterations)
+
+    batch = synthetic_batch(records, batch_size)
+    for messenger in MESSENGERS:
+        event = {'Records': batch['Records'][:1]}
+        report['handle_event'][messenger] = timed(lambda: app.handle_event(messenger, event), iterations)
+        app.DESTINATIONS = [{'messenger': messenger, 'webhook_url': url}]
+        report['lambda_handler'][messenger] = timed(lambda: app.lambda_handler(event, None), iterations)
+        report['lambda_handler'][f'{messenger}_batch_{batch_size}'] = timed(lambda: app.lambda_handler(batch, None), max(iterations // 10, 1))
+    return report
+
+# Flatten the p50 of every measurement
+def medians(report, prefix=''):
+    flat = dict()
+    for key, value in report.items():
+        if isinstance(value, dict) and 'p50' in value:
+            flat[f'{prefix}{key}'] = value['p50']
+        elif isinstance(value, dict):
+            flat.update(medians(value, f'{prefix}{key}.'))
+    return flat
+
+# Measurements whose p50 got slower than the baseline by more than max_regression
+def regressions(report, baseline, max_regression):
+    current = medians(report)
+    previous = medians(baseline)
+    return {
+        key: (previous[key], value)
+        for key, value in current.items()
+        if key in previous and not key.startswith('cold_import') and previous[key] > 0 and value > previous[key] * (1 + max_regression)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the notifications function')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('--import-runs', type=int, default=5)
+    parser.add_argument('--webhook-delay', type=float, default=0.0, help='seconds the stub waits before answering')
+    parser.add_argument('--output', help='write the report as JSON to this file')
+    parser.add_argument('--baseline', help='report to compare with, exits with status 1 on regressions')
+    parser.add_argument('--max-regression', type=float, default=0.2)
+    parser.add_argument('--log-level', default='CRITICAL', help='log level of the function while benchmarking')
+    args = parser.parse_args()
+
+    server, url = start_stub(args.webhook_delay)
+    os.environ.setdefault('AWS_REGION', 'us-east-1')
+    os.environ['WEBHOOK_URL'] = url
+    os.environ['MESSENGER'] = 'slack'
+    os.environ.pop('DESTINATIONS', None)
+    # Measure the function, not the webhook rate limits
+    os.environ['RATE_LIMITS'] = json.dumps({messenger: {'rate': 1e9, 'burst': 1e9} for messenger in MESSENGERS})
+    sys.path.insert(0, FUNCTIONS_DIR)
+    import app
+    app.log.setLevel(args.log_level.upper())
+
+    records = load_records()
+    report = benchmark(app, records, url, args.iterations, args.batch_size)
+    report['cold_import'] = cold_import(url, args.import_runs, {'Records': records['cloudwatch-event-trigger'][:1]})
+    server.shutdown()
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            slower = regressions(report, json.load(file), args.max_regression)
+        for key, (previous, current) in sorted(slower.items()):
+            print(f'Regression: {key} p50 {previous}ms -> {current}ms', file=sys.stderr)
+        if slower:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
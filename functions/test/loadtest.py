@@ -0,0 +1,232 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import itertools
+import collections
+import concurrent.futures
+import http.server
+
+import benchmark
+
+# Local load test replaying events through lambda_handler at a target rate, against a local webhook sink simulating
+# latency, throttling (429) and server errors (5xx). Reports the throughput, the invocation tail latency and the loss,
+# to exercise rate limiting, batching and retries before production storms. Function settings (RATE_LIMITS,
+# DELIVERY_MODE, COALESCE_WINDOW, ...) are read from the environment as in Lambda.
+#
+#   python3 test/loadtest.py --rate 200 --duration 30 --batch-size 10 --no-rate-limits
+#   python3 test/loadtest.py --events storm.ndjson --rate 50 --latency 0.2 --throttle-rate 0.1 --error-rate 0.05
+#   python3 test/loadtest.py --sqs --concurrency 4 --messenger slack --messenger discord --output report.json
+
+# ---------------------------------------------------------------------------------------------------------------------
+# WEBHOOK SINK
+# ---------------------------------------------------------------------------------------------------------------------
+
+class WebhookSink(benchmark.WebhookStub):
+    latency = 0.0
+    jitter = 0.0
+    throttle_rate = 0.0
+    error_rate = 0.0
+    retry_after = 1
+    lock = threading.Lock()
+    statuses = collections.Counter()
+    accepted = collections.Counter()
+
+    # Throttled and failed requests are drawn at random, accepted ones are counted by path (one path per messenger)
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+        draw = random.random()
+        if draw < self.throttle_rate:
+            status = 429
+        elif draw < self.throttle_rate + self.error_rate:
+            status = random.choice((500, 502, 503))
+        else:
+            status = 200
+        with self.lock:
+            self.statuses[status] += 1
+            if status == 200:
+                self.accepted[self.path.strip('/')] += 1
+        self.send_response(status)
+        if status == 429:
+            self.send_header('Retry-After', str(self.retry_after))
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+def start_sink(args):
+    WebhookSink.latency = args.latency
+    WebhookSink.jitter = args.jitter
+    WebhookSink.throttle_rate = args.throttle_rate
+    WebhookSink.error_rate = args.error_rate
+    WebhookSink.retry_after = args.retry_after
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), WebhookSink)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+# ---------------------------------------------------------------------------------------------------------------------
+# EVENTS
+# ---------------------------------------------------------------------------------------------------------------------
+
+# Records of a newline delimited JSON file, lines are Lambda events, SNS or SQS records, or raw event messages
+def read_events(path):
+    with open(path) as file:
+        for number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if 'Records' in item:
+                yield from item['Records']
+            elif 'Sns' in item or 'eventSource' in item:
+                yield item
+            else:
+                yield benchmark.sns_record(item, f'{os.path.basename(path)}-{number}')
+
+# SQS record carrying the message of a record, as delivered by a queue event source mapping
+def sqs_record(record, message_id):
+    if record.get('eventSource') == 'aws:sqs':
+        return {**record, 'messageId': message_id}
+    body = record['Sns']['Message'] if 'Sns' in record else json.dumps(record)
+    return {'eventSource': 'aws:sqs', 'messageId': message_id, 'body': body}
+
+# Endless stream of records with unique ids, cycling through the given records
+def record_stream(records, sqs):
+    for number, record in enumerate(itertools.cycle(records)):
+        message_id = f'loadtest-{number}'
+        if sqs:
+            yield sqs_record(record, message_id)
+        elif 'Sns' in record:
+            yield {**record, 'Sns': {**record['Sns'], 'MessageId': message_id}}
+        else:
+            yield record
+
+# ---------------------------------------------------------------------------------------------------------------------
+# LOAD TEST
+# ---------------------------------------------------------------------------------------------------------------------
+
+# Record statuses of a lambda_handler response, SQS batches only report their failures
+def record_statuses(event, response):
+    if isinstance(response, dict):
+        failed = len(response.get('batchItemFailures', []))
+        return {'failed': failed, 'succeeded': len(event['Records']) - failed}
+    return collections.Counter(result['status'] for result in json.loads(response)['results'])
+
+# Invocations are scheduled at fixed times whatever the previous ones took (open loop), latencies are measured from
+# the scheduled time so a saturated function shows up as queueing instead of a lower request rate
+def run(app, stream, args):
+    interval = args.batch_size / args.rate if args.rate else 0
+    deadline = time.monotonic() + args.duration if args.duration else None
+    service, response = list(), list()
+    statuses = collections.Counter()
+    errors = collections.Counter()
+    lock = threading.Lock()
+
+    def invoke(event, scheduled):
+        started = time.monotonic()
+        try:
+            result = record_statuses(event, app.lambda_handler(event, None))
+        except Exception as exception:
+            result = {'error': len(event['Records'])}
+            with lock:
+                errors[repr(exception)] += 1
+        finished = time.monotonic()
+        with lock:
+            service.append(finished - started)
+            response.append(finished - scheduled)
+            statuses.update(result)
+
+    started = time.monotonic()
+    sent = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for invocation in itertools.count():
+            if args.count and sent >= args.count:
+                break
+            scheduled = started + invocation * interval
+            if deadline and scheduled >= deadline:
+                break
+            size = min(args.batch_size, args.count - sent) if args.count else args.batch_size
+            event = {'Records': list(itertools.islice(stream, size))}
+            sent += size
+            wait = scheduled - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            executor.submit(invoke, event, scheduled)
+    elapsed = time.monotonic() - started
+
+    lost = statuses['failed'] + statuses['error']
+    return {
+        'records': sent,
+        'invocations': len(service),
+        'elapsed_s': round(elapsed, 3),
+        'throughput': {
+            'target_records_per_s': args.rate or None,
+            'records_per_s': round(sent / elapsed, 2),
+            'webhook_accepted_per_s': round(sum(WebhookSink.accepted.values()) / elapsed, 2),
+        },
+        'invocation_ms': benchmark.percentiles(service),
+        'response_ms': benchmark.percentiles(response),
+        'records_by_status': dict(statuses),
+        'loss': {'records': lost, 'rate': round(lost / sent, 4) if sent else 0},
+        'webhook': {
+            'responses': {str(status): count for status, count in sorted(WebhookSink.statuses.items())},
+            'accepted': dict(WebhookSink.accepted),
+        },
+        'errors': dict(errors),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Local load test of the notifications function')
+    parser.add_argument('--events', nargs='*', help='newline delimited JSON files to replay, defaults to the fixtures of this directory')
+    parser.add_argument('--rate', type=float, default=100, help='target records per second, 0 sends as fast as possible')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to send for, 0 for no limit')
+    parser.add_argument('--count', type=int, default=0, help='records to send, 0 for no limit')
+    parser.add_argument('--batch-size', type=int, default=1, help='records per invocation')
+    parser.add_argument('--concurrency', type=int, default=1, help='invocations in flight, as concurrent warm containers')
+    parser.add_argument('--sqs', action='store_true', help='send the records as SQS records, failures are reported as batch item failures')
+    parser.add_argument('--messenger', action='append', choices=benchmark.MESSENGERS, help='destination messenger, repeat for several destinations')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the sink waits before answering')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra seconds added to the sink latency')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of requests answered 429')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered 5xx')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds of the 429 responses')
+    parser.add_argument('--no-rate-limits', action='store_true', help='lift the webhook rate limits to measure the function alone')
+    parser.add_argument('--seed', type=int, help='seed of the simulated failures')
+    parser.add_argument('--output', help='write the report as JSON to this file')
+    parser.add_argument('--log-level', default='CRITICAL', help='log level of the function while load testing')
+    args = parser.parse_args()
+    if not args.duration and not args.count:
+        parser.error('--duration or --count is required to stop')
+    random.seed(args.seed)
+
+    server, url = start_sink(args)
+    os.environ.setdefault('AWS_REGION', 'us-east-1')
+    os.environ['DESTINATIONS'] = json.dumps([
+        {'messenger': messenger, 'webhook_url': f'{url}/{messenger}'}
+        for messenger in args.messenger or ['slack']
+    ])
+    if args.no_rate_limits:
+        os.environ['RATE_LIMITS'] = json.dumps({messenger: {'rate': 1e9, 'burst': 1e9} for messenger in benchmark.MESSENGERS})
+    sys.path.insert(0, benchmark.FUNCTIONS_DIR)
+    import app
+    app.log.setLevel(args.log_level.upper())
+
+    if args.events:
+        records = [record for path in args.events for record in read_events(path)]
+    else:
+        records = [record for fixture in benchmark.load_records().values() for record in fixture]
+    report = run(app, record_stream(records, args.sqs), args)
+    server.shutdown()
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+import os
+import sys
+import json
+import tempfile
+import subprocess
+import unittest
+import threading
+import http.server
+
+import benchmark
+
+# Offline tests of lambda_handler against the local webhook stub of the benchmark, no network access or AWS
+# credentials are needed.
+#
+#   python3 -m unittest discover -s test
+
+app = None
+server = None
+url = None
+
+def setUpModule():
+    global app, server, url
+    server, url = benchmark.start_stub()
+    os.environ.setdefault('AWS_REGION', 'us-east-1')
+    os.environ['WEBHOOK_URL'] = url
+    os.environ['MESSENGER'] = 'slack'
+    os.environ.pop('DESTINATIONS', None)
+    sys.path.insert(0, benchmark.FUNCTIONS_DIR)
+    import app
+    app.log.setLevel('CRITICAL')
+
+def tearDownModule():
+    server.shutdown()
+
+def fixture(name):
+    return benchmark.load_records()[name][0]
+
+def sqs_record(body, message_id):
+    return {'eventSource': 'aws:sqs', 'messageId': message_id, 'body': body}
+
+class SQSTest(unittest.TestCase):
+    def test_unreadable_body_is_a_batch_item_failure(self):
+        event = {'Records': [
+            sqs_record(fixture('cloudwatch-event-trigger')['Sns']['Message'], 'readable'),
+            sqs_record('{not json', 'unreadable'),
+        ]}
+        response = app.lambda_handler(event, None)
+        self.assertEqual(response, {'batchItemFailures': [{'itemIdentifier': 'unreadable'}]})
+
+class RuleTest(unittest.TestCase):
+    def test_priority_is_rendered_without_changing_the_message(self):
+        message = json.loads(fixture('cloudwatch-event-trigger')['Sns']['Message'])
+        original = dict(message)
+        notification = app.notify(message, app.Rule({'priority': 'P1', 'destinations': ['squadcast']}))
+        self.assertEqual(message, original)
+        self.assertEqual(notification.destinations, ['squadcast'])
+        payload = json.loads(app.render_notification('squadcast', notification))
+        self.assertTrue(payload['description'].endswith('**Priority:** P1'))
+
+class SlowStub(benchmark.WebhookStub):
+    delay = 2.0
+
+class TimeoutTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), SlowStub)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/services/T000/B000/webhooktoken'
+
+    def tearDown(self):
+        self.server.shutdown()
+
+    def test_timeout_does_not_name_the_webhook_token(self):
+        client = app.HTTPClient(1, 0.5, 5, 0, 0, 0)
+        with self.assertRaises(app.ResponseTimeout) as raised:
+            client.request('POST', self.url, b'{}')
+        self.assertNotIn('webhooktoken', str(raised.exception))
+
+    def test_async_timeout_does_not_name_the_webhook_token(self):
+        import async_delivery
+        client = async_delivery.AsyncHTTPClient(1, 0.5, 5, 0, lambda attempt, headers: 0, app.RETRY_STATUS_CODES)
+        with self.assertRaises(async_delivery.ResponseTimeout) as raised:
+            async_delivery.loop.run_until_complete(client.request('POST', self.url, b'{}'))
+        self.assertNotIn('webhooktoken', str(raised.exception))
+
+class LifecycleTest(unittest.TestCase):
+    def test_shared_store_references_are_not_cached(self):
+        import stores
+        import lifecycle
+
+        class SharedStore(stores.FileStore):
+            shared = True
+
+        with tempfile.TemporaryDirectory() as directory:
+            store = SharedStore(os.path.join(directory, 'store.json'))
+            first, second = lifecycle.LifecycleStore(store), lifecycle.LifecycleStore(store)
+            first.put('aws.cloudwatch:alarm', {'id': '1'})
+            self.assertEqual(second.get('aws.cloudwatch:alarm'), {'id': '1'})
+            second.delete('aws.cloudwatch:alarm')
+            self.assertIsNone(first.get('aws.cloudwatch:alarm'))
+
+    def test_response_without_json_is_delivered(self):
+        for data in (b'', b'1', b'<html></html>'):
+            self.assertEqual(app.lifecycle_status('discord', 200, data, 'aws.cloudwatch:alarm', None, False), 200)
+
+# Invokes the function imported with the environment of the test, routing is configured when the module is imported
+ROUTED_SCRIPT = """
+import sys, json, app
+app.log.setLevel('CRITICAL')
+print(app.lambda_handler(json.loads(sys.argv[1]), None))
+"""
+
+class RoutingTest(unittest.TestCase):
+    routes = [{'account': '111111111111', 'destinations': [{'messenger': 'discord', 'webhook_url': 'http://127.0.0.1:9/unused'}]}]
+
+    def invoke(self, **environment):
+        env = dict(os.environ, ROUTES=json.dumps(self.routes), **environment)
+        event = {'Records': [fixture('cloudwatch-event-trigger')]}
+        return subprocess.run([sys.executable, '-c', ROUTED_SCRIPT, json.dumps(event)], cwd=benchmark.FUNCTIONS_DIR, env=env, capture_output=True, text=True)
+
+    def test_unrouted_event_goes_to_the_default_destination(self):
+        output = self.invoke()
+        self.assertEqual(output.returncode, 0, output.stderr)
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+        self.assertEqual(result['results'][0]['status'], 'delivered')
+
+    def test_routes_without_catch_all_need_a_default_destination(self):
+        output = self.invoke(WEBHOOK_URL='', MESSENGER='')
+        self.assertNotEqual(output.returncode, 0)
+        self.assertIn('catch-all', output.stderr)
+
+if __name__ == '__main__':
+    unittest.main()
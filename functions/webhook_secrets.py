@@ -0,0 +1,121 @@
+import os
+import json
+import time
+import base64
+import logging
+import threading
+
+# ---------------------------------------------------------------------------------------------------------------------
+# ENVIRONMENT VARIABLES
+# ---------------------------------------------------------------------------------------------------------------------
+
+WEBHOOK_SECRET_TTL = float(os.getenv('WEBHOOK_SECRET_TTL', '900'))
+WEBHOOK_SECRET_REFRESH = float(os.getenv('WEBHOOK_SECRET_REFRESH', '0.8'))
+WEBHOOK_KMS_ENCRYPTION_CONTEXT = json.loads(os.getenv('WEBHOOK_KMS_ENCRYPTION_CONTEXT') or '{}')
+KMS_ENDPOINT = os.getenv('KMS_ENDPOINT', '')
+SECRETS_MANAGER_ENDPOINT = os.getenv('SECRETS_MANAGER_ENDPOINT', '')
+
+# ---------------------------------------------------------------------------------------------------------------------
+# WEBHOOK SECRETS
+# ---------------------------------------------------------------------------------------------------------------------
+# Webhook URLs are given in plain text, as a Secrets Manager secret ARN, or as a base64 KMS ciphertext. Resolved
+# values are cached by the warm container for WEBHOOK_SECRET_TTL seconds and refreshed in the background once
+# WEBHOOK_SECRET_REFRESH of the TTL has elapsed, so only the first invocation waits for KMS or Secrets Manager.
+# KMS_ENDPOINT and SECRETS_MANAGER_ENDPOINT point them to local stubs for offline testing.
+
+log = logging.getLogger()
+
+SECRETS_MANAGER_PREFIX = 'arn:aws:secretsmanager:'
+
+clients = {}
+clients_lock = threading.Lock()
+
+def client(service, endpoint_url):
+    with clients_lock:
+        if service not in clients:
+            import boto3
+            clients[service] = boto3.client(service, endpoint_url=endpoint_url or None)
+        return clients[service]
+
+def is_plaintext(value):
+    return value.startswith(('https://', 'http://'))
+
+# Decrypt a base64 KMS ciphertext, the key is read from the ciphertext itself
+def kms_decrypt(value):
+    params = {'CiphertextBlob': base64.b64decode(value)}
+    if WEBHOOK_KMS_ENCRYPTION_CONTEXT:
+        params['EncryptionContext'] = WEBHOOK_KMS_ENCRYPTION_CONTEXT
+    return client('kms', KMS_ENDPOINT).decrypt(**params)['Plaintext'].decode('utf-8')
+
+# Secret string of a Secrets Manager secret, either the value or a JSON object with the value under `key`
+def secret_value(arn, key='webhook_url'):
+    secret = client('secretsmanager', SECRETS_MANAGER_ENDPOINT).get_secret_value(SecretId=arn)['SecretString']
+    if secret.lstrip().startswith('{'):
+        return json.loads(secret)[key]
+    return secret
+
+def fetch(value):
+    if value.startswith(SECRETS_MANAGER_PREFIX):
+        return secret_value(value)
+    return kms_decrypt(value)
+
+class SecretCache:
+    def __init__(self, fetch, ttl=WEBHOOK_SECRET_TTL, refresh=WEBHOOK_SECRET_REFRESH):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self._data = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def _load(self, key):
+        value = self.fetch(key)
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+        return value
+
+    def _refresh(self, key):
+        try:
+            self._load(key)
+        except Exception:
+            # The cached value stays in use until it expires
+            log.warning('Error refreshing webhook secret, keeping the cached value', exc_info=True)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            age = time.monotonic() - entry[1] if entry else None
+            if entry is not None and age < self.ttl:
+                self.hits += 1
+                if age >= self.ttl * self.refresh and key not in self._refreshing:
+                    self._refreshing.add(key)
+                    threading.Thread(target=self._refresh, args=(key,), daemon=True).start()
+                return entry[0]
+            self.misses += 1
+        return self._load(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+cache = SecretCache(fetch)
+
+# Plain text webhook URL of a destination
+def resolve(value):
+    if is_plaintext(value):
+        return value
+    return cache.get(value)
+
+# Slack bot tokens, JSON secrets keep them under a `token` key
+token_cache = SecretCache(lambda arn: secret_value(arn, 'token'))
+
+# Plain text bot token of a destination, given in plain text or as a Secrets Manager secret ARN
+def resolve_token(value):
+    if value.startswith(SECRETS_MANAGER_PREFIX):
+        return token_cache.get(value)
+    return value
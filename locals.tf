@@ -12,10 +12,57 @@ locals {
     resources = [replace("${try(aws_cloudwatch_log_group.lambda[0].arn, "")}:*", ":*:*", ":*")]
   }
 
+  store_table_name = try(aws_dynamodb_table.store[0].name, var.store_table_name)
+
+  # Scheduled invocations flush the coalescing buffers and the retries of store backed outboxes
+  flush_schedule = var.coalesce_window > 0 || contains(["memory", "file", "dynamodb"], var.outbox_store)
+
+  lambda_policy_document_outbox = {
+    sid       = "AllowOutboxQueues"
+    effect    = "Allow"
+    actions   = ["sqs:SendMessage", "sqs:ReceiveMessage", "sqs:DeleteMessage", "sqs:GetQueueAttributes"]
+    resources = [for queue in concat(aws_sqs_queue.outbox, aws_sqs_queue.outbox_dead_letter) : queue.arn]
+  }
+
+  lambda_policy_document_events_queue = {
+    sid       = "AllowEventsQueueConsume"
+    effect    = "Allow"
+    actions   = ["sqs:ReceiveMessage", "sqs:DeleteMessage", "sqs:GetQueueAttributes"]
+    resources = [for queue in aws_sqs_queue.events : queue.arn]
+  }
+
+  lambda_policy_document_alarm_metadata = {
+    sid       = "AllowAlarmMetadataRead"
+    effect    = "Allow"
+    actions   = ["cloudwatch:DescribeAlarms", "cloudwatch:ListTagsForResource"]
+    resources = ["*"]
+  }
+
+  lambda_policy_document_routes = {
+    sid       = "AllowRoutesRead"
+    effect    = "Allow"
+    actions   = ["s3:GetObject"]
+    resources = ["arn:${data.aws_partition.current.id}:s3:::${replace(var.routes_uri, "s3://", "")}"]
+  }
+
+  lambda_policy_document_dynamodb = {
+    sid       = "AllowStoreTableAccess"
+    effect    = "Allow"
+    actions   = ["dynamodb:GetItem", "dynamodb:PutItem", "dynamodb:UpdateItem", "dynamodb:DeleteItem", "dynamodb:Scan"]
+    resources = ["arn:${data.aws_partition.current.id}:dynamodb:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:table/${var.store_table_name}"]
+  }
+
   lambda_policy_document_kms = {
     sid       = "AllowKMSDecrypt"
     effect    = "Allow"
     actions   = ["kms:Decrypt"]
     resources = [var.kms_key_arn]
   }
+
+  lambda_policy_document_secrets = {
+    sid       = "AllowWebhookSecretsRead"
+    effect    = "Allow"
+    actions   = ["secretsmanager:GetSecretValue"]
+    resources = var.webhook_secret_arns
+  }
 }
@@ -21,8 +21,9 @@ resource "aws_sns_topic_policy" "default" {
   policy = data.aws_iam_policy_document.sns_topic_policy.json
 }
 
+# With `create_sqs_queue` the topic feeds the events queue instead, see `aws_sns_topic_subscription.events`
 resource "aws_sns_topic_subscription" "sns_notify_slack" {
-  count = var.create ? 1 : 0
+  count = var.create && !var.create_sqs_queue ? 1 : 0
 
   topic_arn     = local.sns_topic_arn
   protocol      = "lambda"
@@ -63,16 +64,50 @@ module "lambda" {
   policy_json                       = try(data.aws_iam_policy_document.lambda[0].json, "")
   use_existing_cloudwatch_log_group = true
   attach_network_policy             = var.lambda_function_vpc_subnet_ids != null
-  environment_variables = {
-    WEBHOOK_URL = var.webhook_url
-    MESSENGER   = var.messenger
-  }
-  allowed_triggers = {
+  environment_variables = merge(var.lambda_function_environment_variables, {
+    WEBHOOK_URL                  = var.webhook_url
+    MESSENGER                    = var.messenger
+    DESTINATIONS                 = jsonencode(var.destinations)
+    COALESCE_WINDOW              = tostring(var.coalesce_window)
+    COALESCE_MAX_COUNT           = tostring(var.coalesce_max_count)
+    COALESCE_SOURCES             = join(",", var.coalesce_sources)
+    COALESCE_STORE               = var.coalesce_store
+    DEDUP_WINDOW                 = tostring(var.dedup_window)
+    DEDUP_STORE                  = var.dedup_store
+    DELIVERY_MODE                = var.delivery_mode
+    RULES                        = jsonencode(var.rules)
+    STYLES                       = jsonencode(var.styles)
+    ALARM_METADATA               = tostring(var.alarm_metadata)
+    RATE_LIMITS                  = jsonencode(var.rate_limits)
+    RATE_LIMIT_MAX_WAIT          = tostring(var.rate_limit_max_wait)
+    LOG_FORMAT                   = var.log_format
+    METRICS_NAMESPACE            = var.metrics_namespace
+    STORE_DYNAMODB_TABLE         = local.store_table_name
+    OUTBOX_STORE                 = var.outbox_store
+    OUTBOX_MAX_ATTEMPTS          = tostring(var.outbox_max_attempts)
+    OUTBOX_QUEUE_URL             = try(aws_sqs_queue.outbox[0].url, "")
+    OUTBOX_DEAD_LETTER_QUEUE_URL = try(aws_sqs_queue.outbox_dead_letter[0].url, "")
+    LIFECYCLE_STORE              = var.lifecycle_store
+    ROUTES                       = jsonencode(var.routes)
+    ROUTES_URI                   = var.routes_uri
+    ROUTES_RELOAD_INTERVAL       = tostring(var.routes_reload_interval)
+  })
+  allowed_triggers = merge(var.create_sqs_queue ? {} : {
     AllowExecutionFromSNS = {
       principal  = "sns.amazonaws.com"
       source_arn = local.sns_topic_arn
     }
-  }
+    }, local.flush_schedule ? {
+    AllowExecutionFromEventBridgeSchedule = {
+      principal  = "events.amazonaws.com"
+      source_arn = aws_cloudwatch_event_rule.flush[0].arn
+    }
+    } : {}, {
+    for name, rule in aws_cloudwatch_event_rule.events : "AllowExecutionFromEventBridge-${name}" => {
+      principal  = "events.amazonaws.com"
+      source_arn = rule.arn
+    } if !var.create_sqs_queue
+  })
   store_on_s3            = var.lambda_function_store_on_s3
   s3_bucket              = var.lambda_function_s3_bucket
   vpc_subnet_ids         = var.lambda_function_vpc_subnet_ids
@@ -80,3 +115,124 @@ module "lambda" {
   tags                   = merge(var.tags, var.lambda_function_tags)
   depends_on             = [aws_cloudwatch_log_group.lambda]
 }
+
+resource "aws_dynamodb_table" "store" {
+  count = var.create_store_table && var.create ? 1 : 0
+
+  name         = var.store_table_name
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "key"
+
+  attribute {
+    name = "key"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+
+  tags = var.tags
+}
+
+resource "aws_cloudwatch_event_rule" "flush" {
+  count = local.flush_schedule && var.create ? 1 : 0
+
+  name                = "${var.lambda_function_name}-flush"
+  description         = "Flushes the coalesced notifications and delivery retries of ${var.lambda_function_name}"
+  schedule_expression = "rate(1 minute)"
+  tags                = var.tags
+}
+
+resource "aws_cloudwatch_event_target" "flush" {
+  count = local.flush_schedule && var.create ? 1 : 0
+
+  rule = aws_cloudwatch_event_rule.flush[0].name
+  arn  = module.lambda.lambda_function_arn
+}
+
+resource "aws_cloudwatch_event_rule" "events" {
+  for_each = var.create ? var.event_patterns : {}
+
+  name          = "${var.lambda_function_name}-${each.key}"
+  description   = "Sends the ${each.key} events to ${var.lambda_function_name}"
+  event_pattern = jsonencode(each.value)
+  tags          = var.tags
+}
+
+resource "aws_cloudwatch_event_target" "events" {
+  for_each = aws_cloudwatch_event_rule.events
+
+  rule = each.value.name
+  arn  = var.create_sqs_queue ? aws_sqs_queue.events[0].arn : module.lambda.lambda_function_arn
+}
+
+# Events of the aggregated accounts sent to the default event bus, matched by the rules of `event_patterns`
+resource "aws_cloudwatch_event_permission" "aggregation" {
+  for_each = var.create ? toset(var.aggregation_account_ids) : []
+
+  principal    = each.value
+  statement_id = "${var.lambda_function_name}-${each.value}"
+}
+
+resource "aws_sqs_queue" "events" {
+  count = var.create_sqs_queue && var.create ? 1 : 0
+
+  name                       = "${var.lambda_function_name}-events"
+  visibility_timeout_seconds = 180
+  tags                       = var.tags
+}
+
+resource "aws_sqs_queue_policy" "events" {
+  count = var.create_sqs_queue && var.create ? 1 : 0
+
+  queue_url = aws_sqs_queue.events[0].id
+  policy    = data.aws_iam_policy_document.events_queue[0].json
+}
+
+# The SNS topic and the rules of `event_patterns` send to the queue, which feeds the function in batches.
+# The envelope is kept, the function reads the SNS message out of it
+resource "aws_sns_topic_subscription" "events" {
+  count = var.create_sqs_queue && var.create ? 1 : 0
+
+  topic_arn     = local.sns_topic_arn
+  protocol      = "sqs"
+  endpoint      = aws_sqs_queue.events[0].arn
+  filter_policy = var.subscription_filter_policy
+}
+
+resource "aws_lambda_event_source_mapping" "events" {
+  count = var.create_sqs_queue && var.create ? 1 : 0
+
+  event_source_arn                   = aws_sqs_queue.events[0].arn
+  function_name                      = module.lambda.lambda_function_arn
+  batch_size                         = var.sqs_batch_size
+  maximum_batching_window_in_seconds = var.sqs_maximum_batching_window
+  function_response_types            = ["ReportBatchItemFailures"]
+}
+
+resource "aws_sqs_queue" "outbox" {
+  count = var.outbox_store == "sqs" && var.create ? 1 : 0
+
+  name                       = "${var.lambda_function_name}-outbox"
+  visibility_timeout_seconds = 180
+  tags                       = var.tags
+}
+
+resource "aws_sqs_queue" "outbox_dead_letter" {
+  count = var.outbox_store == "sqs" && var.create ? 1 : 0
+
+  name                      = "${var.lambda_function_name}-outbox-dead-letter"
+  message_retention_seconds = 1209600
+  tags                      = var.tags
+}
+
+resource "aws_lambda_event_source_mapping" "outbox" {
+  count = var.outbox_store == "sqs" && var.create ? 1 : 0
+
+  event_source_arn        = aws_sqs_queue.outbox[0].arn
+  function_name           = module.lambda.lambda_function_arn
+  batch_size              = 10
+  function_response_types = ["ReportBatchItemFailures"]
+}
@@ -17,3 +17,13 @@ output "lambda_function_arn" {
   description = "The ARN of the Lambda Function"
   value       = module.lambda.lambda_function_arn
 }
+
+output "sqs_queue_arn" {
+  description = "The ARN of the SQS queue feeding the Lambda Function, when created"
+  value       = try(aws_sqs_queue.events[0].arn, "")
+}
+
+output "sqs_queue_url" {
+  description = "The URL of the SQS queue feeding the Lambda Function, when created"
+  value       = try(aws_sqs_queue.events[0].url, "")
+}
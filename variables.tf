@@ -30,7 +30,7 @@ variable "lambda_description" {
 variable "lambda_layers" {
   description = "(Optional) List of Lambda Layer Version ARNs (maximum of 5) to attach to your Lambda Function"
   type        = list(string)
-  default     = ["arn:aws:lambda:us-east-1:668099181075:layer:AWSLambda-Python-AWS-SDK:4"]
+  default     = []
 }
 
 variable "sns_topic_name" {
@@ -50,6 +50,12 @@ variable "kms_key_arn" {
   default     = ""
 }
 
+variable "webhook_secret_arns" {
+  description = "(Optional) ARNs of the Secrets Manager secrets referenced as webhook URLs, holding the URL or a JSON object with a `webhook_url` key. Webhook URLs can also be base64 KMS ciphertexts of the `kms_key_arn` key"
+  type        = list(string)
+  default     = []
+}
+
 variable "recreate_missing_package" {
   description = "Whether to recreate missing Lambda package if it is missing locally or not"
   type        = bool
@@ -116,6 +122,12 @@ variable "lambda_function_tags" {
   default     = {}
 }
 
+variable "lambda_function_environment_variables" {
+  description = "Additional environment variables for the Lambda Function, e.g. HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, HTTP_TOTAL_TIMEOUT, HTTP_MAX_RETRIES, HTTP_BACKOFF_BASE and HTTP_BACKOFF_MAX to tune webhook delivery"
+  type        = map(string)
+  default     = {}
+}
+
 variable "lambda_function_vpc_subnet_ids" {
   description = "List of subnet ids when Lambda Function should run in the VPC. Usually private or intra subnets."
   type        = list(string)
@@ -164,12 +176,182 @@ variable "subscription_filter_policy" {
   default     = null
 }
 
+variable "event_patterns" {
+  description = "(Optional) EventBridge rules invoking the function directly, without the SNS topic, as a map of rule name suffixes to event patterns, e.g. `{ pipelines = { source = [\"aws.codepipeline\"] } }`"
+  type        = any
+  default     = {}
+}
+
+variable "create_sqs_queue" {
+  description = "(Optional) Whether to create a SQS queue feeding the function in batches. The SNS topic and the rules of `event_patterns` send to the queue instead of invoking the function, other SNS subscriptions or EventBridge targets may send to it too. Only the failed messages of a batch are redelivered"
+  type        = bool
+  default     = false
+}
+
+variable "sqs_batch_size" {
+  description = "(Optional) Maximum number of messages of the SQS queue handled by one invocation"
+  type        = number
+  default     = 10
+}
+
+variable "sqs_maximum_batching_window" {
+  description = "(Optional) Seconds the SQS queue gathers messages before invoking the function with a batch"
+  type        = number
+  default     = 0
+}
+
 variable "webhook_url" {
   description = "The URL of Slack webhook"
   type        = string
+  default     = ""
 }
 
 variable "messenger" {
   description = "The name of the channel in Slack for notifications"
   type        = string
+  default     = ""
+}
+
+variable "destinations" {
+  description = "(Optional) List of destinations notified concurrently by the same function, each one a map with `messenger`, `webhook_url`, an optional `name` used by `rules`, an optional `filter` list of event sources (e.g. `aws.ecs`, `aws.cloudwatch`) or detail types, and for Slack an optional bot `token` (or the ARN of a Secrets Manager secret holding it, in plain text or under a `token` JSON key) and `channel` posting with the Web API, needed by `lifecycle_store`, with `lifecycle = \"thread\"` to reply in threads instead of updating messages. When set, `webhook_url` and `messenger` are ignored"
+  type        = any
+  default     = []
+}
+
+variable "coalesce_window" {
+  description = "(Optional) Seconds during which notifications sharing a key (ECS service, pipeline, project or alarm) are buffered and sent as a single digest message. 0 disables coalescing"
+  type        = number
+  default     = 0
+}
+
+variable "coalesce_max_count" {
+  description = "(Optional) Number of buffered notifications that sends the digest message before the coalescing window ends"
+  type        = number
+  default     = 20
+}
+
+variable "coalesce_sources" {
+  description = "(Optional) Event sources whose notifications are coalesced, any of `aws.ecs`, `aws.codepipeline`, `aws.codebuild` and `aws.cloudwatch`"
+  type        = list(string)
+  default     = ["aws.ecs"]
+}
+
+variable "coalesce_store" {
+  description = "(Optional) Backend keeping the coalescing buffers: `memory` (per container), `file` (/tmp) or `dynamodb` (shared, requires `store_table_name`, flushed by the scheduled invocations). SQS records are only buffered in `dynamodb`, per container buffers would lose them"
+  type        = string
+  default     = "memory"
+}
+
+variable "create_store_table" {
+  description = "(Optional) Whether to create the DynamoDB table named `store_table_name` used by the shared state backends"
+  type        = bool
+  default     = false
+}
+
+variable "store_table_name" {
+  description = "(Optional) Name of the DynamoDB table used by the shared state backends"
+  type        = string
+  default     = ""
+}
+
+variable "dedup_window" {
+  description = "(Optional) Seconds during which repeated notifications of the same source, resource and state (e.g. flapping alarms or pipeline retries) are dropped. 0 disables deduplication"
+  type        = number
+  default     = 0
+}
+
+variable "dedup_store" {
+  description = "(Optional) Shared backend checked after the in-process deduplication cache: `file` (/tmp) or `dynamodb` (requires `store_table_name`). Empty keeps deduplication per container"
+  type        = string
+  default     = ""
+}
+
+variable "delivery_mode" {
+  description = "(Optional) How several notifications of an invocation are delivered concurrently: `threads` (thread pool) or `async` (asyncio event loop with bounded concurrency)"
+  type        = string
+  default     = "threads"
+}
+
+variable "rules" {
+  description = "(Optional) Rules applied in order to the parsed events before rendering, the first matching one wins. Rules match by `source`, `detail_type`, `state`, `account` and `region` (a value or a list of values, alarms use the region of their ARN) and by `alarm_name` (a regex), and set `drop = true`, `destinations` (destination names or messengers) or `priority` (e.g. `P1`). E.g. `[{ source = \"aws.codebuild\", state = [\"IN_PROGRESS\"], drop = true }]`"
+  type        = any
+  default     = []
+}
+
+variable "metrics_namespace" {
+  description = "(Optional) CloudWatch namespace of the embedded metric format metrics (parse, render and HTTP times, payload sizes, retries, status classes, drops and duplicates) written to the function logs. Empty disables them"
+  type        = string
+  default     = ""
+}
+
+variable "styles" {
+  description = "(Optional) Display status, colors and severity of event states overriding the built-in ones, by event source and state, e.g. `{ \"aws.cloudwatch\" = { INSUFFICIENT_DATA = { color = \"ffa500\", msteams_color = \"warning\", squadcast_status = \"resolve\", severity = \"P4\" } } }`. The `default` state styles the states without a style of their own"
+  type        = any
+  default     = {}
+}
+
+variable "alarm_metadata" {
+  description = "(Optional) Whether to fetch the description and tags of CloudWatch alarms from the CloudWatch API, they are cached by warm containers for 5 minutes"
+  type        = bool
+  default     = false
+}
+
+variable "rate_limits" {
+  description = "(Optional) Rate limits by messenger overriding the defaults, e.g. `{ slack = { rate = 1, burst = 3 } }` where `rate` is in messages per second. Each webhook URL gets its own token bucket"
+  type        = any
+  default     = {}
+}
+
+variable "rate_limit_max_wait" {
+  description = "(Optional) Seconds a message waits for its webhook rate limit before being handed back as failed (redelivered by SQS). The wait counts against the delivery deadline of the invocation, HTTP_TOTAL_TIMEOUT cut to the time the function has left"
+  type        = number
+  default     = 10
+}
+
+variable "log_format" {
+  description = "(Optional) Format of the function logs: `text`, or `json` for JSON lines with request id, source, messenger, render and HTTP timings"
+  type        = string
+  default     = "text"
+}
+
+variable "outbox_store" {
+  description = "(Optional) Backend persisting rendered notifications whose delivery failed, retried with backoff and replayed with the `{\"action\": \"replay\"}` payload: `file` (/tmp, per container), `dynamodb` (requires `store_table_name`) or `sqs` (creates a retry queue and a dead-letter queue). Empty disables retries. `memory` loses the retries with the container and is meant for tests only"
+  type        = string
+  default     = ""
+}
+
+variable "lifecycle_store" {
+  description = "(Optional) Backend remembering the message posted for an alarm, a pipeline execution or a build, so later notifications of it update that message (Discord, and Slack destinations with a `token`) instead of posting new ones: `memory`, `file` or `dynamodb` (requires `store_table_name`). Empty disables it"
+  type        = string
+  default     = ""
+}
+
+variable "routes" {
+  description = "(Optional) Routing table of the aggregation mode, where one function notifies for many accounts and regions: a list of routes with `account`, `region` and `source` (a value, a list of values or `*`, the default) and `destinations` (destination objects or names of `destinations`), e.g. `[{ account = \"111111111111\", source = \"aws.cloudwatch\", destinations = [\"ops\"] }]`. The most specific route wins, an account route over a region route over a source route. Events without route go to `destinations` or to `webhook_url` and `messenger`, without them the table needs a catch-all route"
+  type        = any
+  default     = []
+}
+
+variable "routes_uri" {
+  description = "(Optional) `s3://bucket/key` URI of a JSON routing table added to `routes`, reloaded by warm containers when it changes"
+  type        = string
+  default     = ""
+}
+
+variable "routes_reload_interval" {
+  description = "(Optional) Seconds between the checks for changes of the routing table of `routes_uri`"
+  type        = number
+  default     = 60
+}
+
+variable "aggregation_account_ids" {
+  description = "(Optional) Accounts allowed to publish to the SNS topic and to send events to the default event bus, to aggregate their notifications in this function"
+  type        = list(string)
+  default     = []
+}
+
+variable "outbox_max_attempts" {
+  description = "(Optional) Delivery attempts of a notification before it is moved to the dead letters"
+  type        = number
+  default     = 5
 }